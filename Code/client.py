@@ -1,86 +1,423 @@
 import cv2
+import os
 import socket
-import struct
-import pickle
+import sys
 
 import threading
 import time
-import copy
+
+# Appended rather than prepended, so that the scripts of pytorch_mpiigaze
+# (train.py, demo.py, ...) never shadow installed modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'pytorch_mpiigaze'))
+from gaze_server import protocol  # noqa: E402
+from gaze_server.shm import FrameRing  # noqa: E402
+
+
+class Latest_Frame_Grabber:
+    # Keeps grabbing from the camera in its own thread so the driver never
+    # holds old frames, and only decodes (retrieves) the newest grabbed
+    # frame when the sender asks for one
+    def __init__(self, source=0):
+        # source is a device index, a video path or an opened capture
+        self.source = source
+        self.cap = None
+        self.frame_size = None
+        # cv2.VideoCapture is not thread safe, capture_lock serializes
+        # grab, retrieve and set. lock only guards the frame state below so
+        # that waiting for a frame never waits for a blocking grab. When
+        # both are taken, capture_lock is taken first
+        self.capture_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.frame_grabbed = threading.Condition(self.lock)
+        self.has_frame = False
+        # Set while read() retrieves, the grabber then holds off so it
+        # cannot keep taking capture_lock before read() gets it
+        self.retrieving = False
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def set_frame_size(self, frame_size):
+        with self.capture_lock:
+            self.frame_size = frame_size
+            if self.cap is not None:
+                self.apply_frame_size()
+
+    def apply_frame_size(self):
+        # Must be called with capture_lock held
+        if self.frame_size is not None:
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.frame_size[0])
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.frame_size[1])
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.grab_frames)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open(self):
+        with self.capture_lock:
+            if isinstance(self.source, (int, str)):
+                self.cap = cv2.VideoCapture(self.source)
+            else:
+                self.cap = self.source
+            self.apply_frame_size()
+
+    def grab_frames(self):
+        # The camera is only opened once frames are needed
+        self.open()
+        while not self.stop_event.is_set():
+            with self.lock:
+                self.frame_grabbed.wait_for(
+                    lambda: not self.retrieving or self.stop_event.is_set())
+            # grab() blocks until the camera delivers a frame, only
+            # capture_lock is held meanwhile so read() can still wait on
+            # the frame state
+            with self.capture_lock:
+                grabbed = self.cap.grab()
+                if grabbed:
+                    with self.lock:
+                        self.has_frame = True
+                        self.frame_grabbed.notify_all()
+            if not grabbed:
+                # No frame yet or the camera was disconnected
+                self.stop_event.wait(0.01)
+
+    def read(self, timeout=1.0):
+        # Returns the newest frame, like cv2.VideoCapture.read(). Each
+        # grabbed frame is returned once, a second read waits for the next
+        with self.lock:
+            if not self.frame_grabbed.wait_for(lambda: self.has_frame,
+                                               timeout=timeout):
+                return False, None
+            self.retrieving = True
+        try:
+            with self.capture_lock:
+                # A grab may have finished in between, the newest frame is
+                # retrieved and it is not returned a second time
+                with self.lock:
+                    self.has_frame = False
+                return self.cap.retrieve()
+        finally:
+            with self.lock:
+                self.retrieving = False
+                self.frame_grabbed.notify_all()
+
+    def release(self):
+        self.stop_event.set()
+        with self.lock:
+            self.frame_grabbed.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        if self.cap is not None:
+            self.cap.release()
 
 
 class Gaze_Capture_Client:
-    def __init__(self, fps=11, cap=cv2.VideoCapture(0), server_ip='127.0.0.1', server_port=5004):
-        # Initialize socket
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((server_ip, server_port))
+    def __init__(self, fps=11, cap=0, server_ip='127.0.0.1', server_port=5004,
+                 encoding='raw', quality=90, max_in_flight=4, drain_timeout=2.0,
+                 transport='tcp', reconnect_delay=0.5, max_reconnect_delay=30.0,
+                 score_threshold=7):
+        # encoding is one of raw, jpeg, png or webp. Compressed frames are
+        # worth it when the gaze server runs on another machine, quality
+        # (1-100) only applies to jpeg and webp
+        # Frames are not answered, the server keeps statistics of each
+        # capture and sends them back when the capture is stopped, waiting
+        # at most drain_timeout seconds for the frames already sent.
+        # score_threshold is the score under which frames are counted in
+        # the fraction_below_threshold statistic
+        # transport is tcp or shm. With shm, which needs the server on the
+        # same machine, frames are written once into shared memory and
+        # only the slot index goes over the socket (encoding is ignored).
+        # max_in_flight is then the number of slots, i.e. how many frames
+        # can wait for the server
+        # cap is the camera index (or an opened cv2.VideoCapture), the camera
+        # is opened by the first start_capture
+        # The client connects in the background and reconnects whenever the
+        # connection drops, waiting reconnect_delay seconds after a failed
+        # attempt and doubling the wait up to max_reconnect_delay
+        self.server_address = (server_ip, server_port)
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.client_socket = None  # None while disconnected
+        self.reader = None
+        self.frame_id = 0
+        self.cap = Latest_Frame_Grabber(cap)
+        self.frame_size = None
+        self.grayscale = False
         self.lock = threading.Lock()
-        self.stop_event = None
-        self.worker_thread = None
-        self.cap = cap
+        # Frames and commands are sent from different threads
+        self.send_lock = threading.Lock()
         self.fps = fps
+        self.encoding = protocol.Encoding[encoding.upper()]
+        self.quality = quality
+        self.max_in_flight = max_in_flight
+        self.drain_timeout = drain_timeout
+        self.score_threshold = score_threshold
         # Shared resource
+        self.capture_id = 0
+        self.summary = None  # statistics of the last stopped capture
+        self.summary_received = threading.Condition(self.lock)
+        self.capturing = threading.Event()
+        self.use_shm = transport == 'shm'
+        self.frame_ring = None  # created with the size of the first frame
+        self.ring_attached = False  # on the current connection
 
-    def worker(self, stop_event, results_dict, cap, time_between_frames):
-        while not stop_event.is_set():
-            # Simulate a time-consuming operation
-            time.sleep(time_between_frames)
-            ret, frame = cap.read()
-            # Serialize the image
-            data = pickle.dumps(frame)
-
-            # Send message length first
-            # L is for unsigned long
-            message_size = struct.pack("L", len(data))
-            self.client_socket.sendall(message_size + data)
-
-            # Receive response from server
-            response_length = struct.unpack("L", self.client_socket.recv(8))[
-                0]  # 8 bytes for size
-            response_data = b""
-            while len(response_data) < response_length:
-                response_data += self.client_socket.recv(4096)
-            response_dict = pickle.loads(response_data)
-            #print(f"Server response (dictionary): {response_dict}")
-            if (response_dict["status"] != "error"):
-                gaze_distance = response_dict["score"]
-                with self.lock:  # Ensure thread-safe access
-                    if results_dict["number_of_samples"] == 0:
-                        results_dict["number_of_samples"] = 1
-                        results_dict["average_score"] = gaze_distance
-
-                    old_average_score = results_dict["average_score"]
-
-                    results_dict["average_score"] = ((
-                        old_average_score*results_dict["number_of_samples"]) + gaze_distance)/(results_dict["number_of_samples"]+1)
-
-                    results_dict["number_of_samples"] = results_dict["number_of_samples"] + 1
+        # A single connection and a single worker serve every capture of
+        # the session. Summaries are read by the connection thread.
+        # The threads keep the client alive, the owner must call close()
+        # once done with it. closed is only set up here, so that close()
+        # knows the threads exist
+        self.closed = threading.Event()
+        self.connection_thread = threading.Thread(target=self.maintain_connection)
+        self.connection_thread.daemon = True
+        self.connection_thread.start()
+        self.worker_thread = threading.Thread(target=self.worker)
+        self.worker_thread.daemon = True
+        self.worker_thread.start()
 
-    def start_capture(self):
-        self.results_dict = {}
-        self.results_dict["average_score"] = 0
-        self.results_dict["number_of_samples"] = 1
-        self.stop_event = threading.Event()
+    def maintain_connection(self):
+        delay = self.reconnect_delay
+        while not self.closed.is_set():
+            try:
+                self.connect()
+            except OSError as e:
+                print(f"Cannot connect to the gaze server ({e}), "
+                      f"retrying in {delay:.1f}s")
+                self.closed.wait(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+            delay = self.reconnect_delay
+            self.receiver()
+            self.disconnect()
+
+    def connect(self):
+        sock = socket.create_connection(self.server_address)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.reader = protocol.MessageReader(sock, 4096)
+            self.receive_capture_format()
+        except (OSError, protocol.ProtocolError) as e:
+            sock.close()
+            raise ConnectionError(e) from e
+        with self.lock:
+            self.client_socket = sock
+            self.ring_attached = False
+            if self.frame_ring is not None:
+                # Frames left in the ring will never be processed
+                for slot in range(self.frame_ring.n_slots):
+                    self.frame_ring.release(slot)
+            # The server knows nothing of a capture started before the
+            # connection dropped, its statistics restart from here
+            if self.capturing.is_set():
+                self.send_start(resume=True)
+        print("Connected to the gaze server")
+
+    def disconnect(self):
+        with self.lock:
+            sock, self.client_socket = self.client_socket, None
+            self.summary_received.notify_all()
+        sock.close()
 
-        # Worker function that runs in parallel
+    @staticmethod
+    def drop_connection(sock):
+        # Wakes up the connection thread, which then reconnects
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
+    def receive_capture_format(self):
+        # The server tells us right away which frame size and colors it
+        # needs, so we capture at that size and convert before sending
+        message = self.reader.receive()
+        if message is None or message[0].type != protocol.MessageType.HELLO:
+            raise ConnectionError("Gaze server did not send its capture format")
+        capture_format = protocol.decode_json(message[1])
+        self.frame_size = None
+        if "width" in capture_format and "height" in capture_format:
+            self.frame_size = (capture_format["width"], capture_format["height"])
+            self.cap.set_frame_size(self.frame_size)
+        self.grayscale = capture_format.get("color") == "gray"
+
+    def convert(self, frame):
+        # The camera may not support the requested size
+        if self.frame_size is not None and frame.shape[1::-1] != self.frame_size:
+            frame = cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+        if self.grayscale and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return frame
+
+    def send_start(self, resume=False):
+        # Must be called with the lock held
+        self.send_command(protocol.MessageType.START, capture=self.capture_id,
+                          threshold=self.score_threshold, resume=resume)
+
+    def send_command(self, command, **options):
+        # Must be called with the lock held. While disconnected there is
+        # nothing to do, connect() tells the new connection about a
+        # running capture
+        if self.client_socket is None:
+            return
+        try:
+            with self.send_lock:
+                protocol.send_json(self.client_socket, command, options)
+        except OSError as e:
+            print(f"Error sending {command.name} to the gaze server: {e}")
+            self.drop_connection(self.client_socket)
+
+    def worker(self):
         time_between_frames = 1/self.fps
+        next_capture = time.monotonic()
+        while not self.closed.is_set():
+            if not self.capturing.is_set():
+                self.capturing.wait()
+                next_capture = time.monotonic()
+                continue
+            # Sample on a fixed schedule, independent of the server latency
+            next_capture += time_between_frames
+            delay = next_capture - time.monotonic()
+            if delay > 0:
+                self.closed.wait(delay)
+            else:
+                # We fell behind, do not try to catch up with a burst
+                next_capture = time.monotonic()
 
-        # Start the worker thread
-        self.worker_thread = threading.Thread(target=self.worker, args=(
-            self.stop_event, self.results_dict, self.cap, time_between_frames,))
-        self.worker_thread.daemon = True
-        self.worker_thread.start()
+            with self.lock:
+                if not self.capturing.is_set() or self.client_socket is None:
+                    # Paused or disconnected, skip this sample
+                    continue
+                sock = self.client_socket
+                self.frame_id += 1
+                frame_id = self.frame_id
+
+            ret, frame = self.cap.read()
+            if not ret:
+                continue
+            # The server smooths the head pose over the capture times, the
+            # send below may wait for the server
+            timestamp = time.time()
+            try:
+                # Blocks while the server is behind, the next sample is
+                # then the newest frame again
+                with self.send_lock:
+                    self.send(sock, self.convert(frame), frame_id, timestamp)
+            except OSError as e:
+                print(f"Error sending frame to the gaze server: {e}")
+                self.drop_connection(sock)
+
+    def send(self, sock, frame, frame_id, timestamp=None):
+        if self.use_shm and self.frame_ring is None:
+            self.frame_ring = FrameRing(self.max_in_flight, frame.nbytes)
+        if self.use_shm and not self.ring_attached:
+            protocol.send_json(sock, protocol.MessageType.ATTACH_SHM,
+                               self.frame_ring.describe())
+            self.ring_attached = True
+        if self.use_shm and frame.nbytes <= self.frame_ring.slot_size:
+            slot = self.frame_ring.acquire()
+            if slot is None:
+                # The server still holds every slot, skip this sample
+                return
+            # Only the slot index goes over the socket
+            self.frame_ring.write(slot, frame)
+            protocol.send_shm_frame(sock, frame, frame_id, slot, timestamp)
+        else:
+            # Send the frame behind a fixed-width header
+            protocol.send_frame(sock, frame, frame_id, timestamp,
+                                encoding=self.encoding, quality=self.quality)
+
+    def receiver(self):
+        # Returns when the connection is lost
+        while True:
+            try:
+                message = self.reader.receive()
+            except (OSError, protocol.ProtocolError) as e:
+                print(f"Error receiving from the gaze server: {e}")
+                message = None
+            if message is None:
+                print("Gaze server closed the connection")
+                return
+            header, payload = message
+            if header.type != protocol.MessageType.SUMMARY:
+                continue
+            summary = protocol.decode_json(payload)
+            with self.lock:
+                # A summary that comes too late for its stop_capture is
+                # dropped
+                if summary.get("capture") == self.capture_id:
+                    self.summary = summary
+                    self.summary_received.notify_all()
+
+    def start_capture(self):
+        with self.lock:
+            self.capture_id += 1
+            self.send_start()
+            self.capturing.set()
+        # The camera is opened by the first capture and then kept open
+        self.cap.start()
+
+    def pause_capture(self):
+        with self.lock:
+            self.capturing.clear()
+            self.send_command(protocol.MessageType.PAUSE)
+
+    def resume_capture(self):
+        with self.lock:
+            self.send_start(resume=True)
+            self.capturing.set()
 
     def stop_capture(self):
-        self.stop_event.set()
-        self.worker_thread.join()
         with self.lock:
-            print(self.results_dict)
-        return copy.deepcopy(self.results_dict)
+            self.capturing.clear()
+            self.summary = None
+            self.send_command(protocol.MessageType.STOP)
+            # The server answers once it has processed the frames already
+            # sent
+            self.summary_received.wait_for(
+                lambda: self.summary is not None or self.client_socket is None,
+                timeout=self.drain_timeout)
+            disconnected = self.client_socket is None
+            results_dict = dict(self.summary or {})
+        # Keys read by LingoLab. Without any scored frame there is no
+        # gaze data: average_score is None, which must not be read as a
+        # gaze at the center (a score of 0)
+        results_dict["average_score"] = results_dict.get("mean")
+        results_dict["number_of_samples"] = results_dict.get("count", 0)
+        if results_dict["average_score"] is not None:
+            results_dict["status"] = "success"
+        else:
+            results_dict["status"] = "no_data"
+            if not self.summary:
+                results_dict["reason"] = ("disconnected" if disconnected
+                                          else "timeout")
+            else:
+                results_dict["reason"] = "no_score"
+        print(results_dict)
+        return results_dict
 
-    def __del__(self):
+    def close(self):
+        # Releases the camera, the connection and the shared memory. Safe
+        # to call more than once, or on a client whose __init__ failed
+        closed = getattr(self, "closed", None)
+        if closed is None or closed.is_set():
+            return
+        closed.set()
+        self.capturing.set()  # wakes up the worker
+        with self.lock:
+            if self.client_socket is not None:
+                self.drop_connection(self.client_socket)
+        self.worker_thread.join()
+        # A connection attempt in progress is given up on after a while,
+        # the thread is a daemon
+        self.connection_thread.join(timeout=1.0)
         self.cap.release()
-        self.client_socket.close()
+        if self.frame_ring is not None:
+            self.frame_ring.close()
+
+    def __del__(self):
+        # Only runs once the threads are gone, close() is what stops them
+        self.close()
 
 
 if __name__ == "__main__":
@@ -95,4 +432,4 @@ if __name__ == "__main__":
 
     time.sleep(2)  # Simulate a time-consuming operation
     print(gz_client.stop_capture())
-    del gz_client  # for a secure release of resources
+    gz_client.close()  # for a secure release of resources
@@ -31,7 +31,8 @@ class LingoLab(ctk.CTk):
         self.gaze_distance_treshold = 7
 
         # gaze detection initialization
-        self.gaze_processor = Gaze_Capture_Client()
+        self.gaze_processor = Gaze_Capture_Client(
+            score_threshold=self.gaze_distance_treshold)
 
         # initialize the model for pronunciation feedback
         self.pronunciation_processor = TextPronunciationFluency()
@@ -364,7 +365,9 @@ class LingoLab(ctk.CTk):
         val = self.gaze_processor_output["average_score"]
         diff = (self.end_time - self.start_time).seconds
         print("Gaze acuracy: ", val, " - Seconds taken: ", diff)
-        if(self.emotion_recognizer_pause or (diff > 10 and val < self.gaze_distance_treshold)):
+        # val is None when the gaze server could not score the exercise
+        gaze_low = val is not None and val < self.gaze_distance_treshold
+        if(self.emotion_recognizer_pause or (diff > 10 and gaze_low)):
             self.pause_frame = ctk.CTkFrame(self.exercise_frame, corner_radius=10)
             self.pause_frame.grid(row=2, column=0, padx=20, pady=(0,15), sticky="s")
             self.pause_frame.grid_columnconfigure(0, weight=1)
@@ -423,4 +426,9 @@ class LingoLab(ctk.CTk):
 # Run the app
 if __name__ == "__main__":
     app = LingoLab()
-    app.mainloop()
+    try:
+        app.mainloop()
+    finally:
+        # Releases the camera, the connection and the shared memory of the
+        # gaze client
+        app.gaze_processor.close()
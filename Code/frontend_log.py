@@ -42,7 +42,8 @@ class LingoLab(ctk.CTk):
         self.gaze_distance_treshold = 7
 
         # gaze detection initialization
-        self.gaze_processor = Gaze_Capture_Client()
+        self.gaze_processor = Gaze_Capture_Client(
+            score_threshold=self.gaze_distance_treshold)
 
         # initialize the model for pronunciation feedback
         self.pronunciation_processor = TextPronunciationFluency()
@@ -273,7 +274,8 @@ class LingoLab(ctk.CTk):
         self.fluency_scores.append(fluency)
         self.accuracy_scores.append(1 if accuracy else 0)
         self.sentiment_scores.append(sentiment)
-        self.gaze_scores.append(gaze if gaze != "N/A" else 0)
+        # Exercises without gaze data leave a gap in the graph
+        self.gaze_scores.append(gaze if gaze != "N/A" else float("nan"))
 
 
 
@@ -310,7 +312,9 @@ class LingoLab(ctk.CTk):
         self.accuracy = self.user_answer == correct_answer
 
         # Log statistics
-        gaze_score = self.gaze_processor_output.get("average_score", "N/A") if hasattr(self, "gaze_processor_output") else "N/A"
+        gaze_score = self.gaze_processor_output.get("average_score") if hasattr(self, "gaze_processor_output") else None
+        if gaze_score is None:
+            gaze_score = "N/A"
         exercise_text = self.current_exercise_list[self.current_exercise][0]
         """log_entry = (
             f"Exercise {self.current_exercise + 1}: {exercise_text}\n"
@@ -410,7 +414,9 @@ class LingoLab(ctk.CTk):
                     self.incorrect_grammar += 1
 
             # Gaze and sentiment data
-            gaze_score = self.gaze_processor_output["average_score"] if self.gaze_processor_output else "N/A"
+            gaze_score = self.gaze_processor_output.get("average_score") if self.gaze_processor_output else None
+            if gaze_score is None:
+                gaze_score = "N/A"
 
 
             # Log statistics
@@ -430,7 +436,9 @@ class LingoLab(ctk.CTk):
             val = self.gaze_processor_output["average_score"]
             diff = (self.end_time - self.start_time).seconds
             print("Gaze accuracy: ", val, " - Seconds taken: ", diff)
-            if self.emotion_recognizer_pause or (diff > 10 and val < self.gaze_distance_treshold):
+            # val is None when the gaze server could not score the exercise
+            gaze_low = val is not None and val < self.gaze_distance_treshold
+            if self.emotion_recognizer_pause or (diff > 10 and gaze_low):
                 self.pause_frame = ctk.CTkFrame(self.exercise_frame, corner_radius=10)
                 self.pause_frame.grid(row=2, column=0, padx=20, pady=(0, 15), sticky="s")
                 self.pause_frame.grid_columnconfigure(0, weight=1)
@@ -551,4 +559,9 @@ class LingoLab(ctk.CTk):
 # Run the app
 if __name__ == "__main__":
     app = LingoLab()
-    app.mainloop()
+    try:
+        app.mainloop()
+    finally:
+        # Releases the camera, the connection and the shared memory of the
+        # gaze client
+        app.gaze_processor.close()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""Measures where the time of a frame goes in the gaze pipeline.
+
+Frames are replayed through the same steps as ``Runner.run`` in its
+headless mode, with each step timed separately. For every model and
+thread count of the sweep, the latency percentiles of each stage and the
+throughput of a single stream are reported. Only frames with exactly one
+face go past landmark detection, the others are counted as misses.
+
+Models other than the one of ``--config`` are run with random weights,
+which does not change their speed.
+"""
+
+import argparse
+import collections
+import pathlib
+import time
+from typing import Dict, List
+
+import cv2
+import numpy as np
+import torch
+
+from gaze_estimation import (GazeEstimationMethod, GazeEstimator,
+                             get_default_config)
+from gaze_estimation.gaze_estimator.common import FaceTrack
+from gaze_estimation.gaze_estimator.head_pose_estimation import to_gray
+from gaze_estimation.models import create_model
+from gaze_estimation.utils import iterate_frames
+from gaze_server.face_pipeline import resize_frame
+from gaze_server.scoring import error_to_center, eye_angles
+
+STAGES = [
+    'resize',
+    'undistort',
+    'detect',
+    'landmarks',
+    'solvepnp',
+    'normalize',
+    'model_input',
+    'forward',
+    'postprocess',
+]
+
+
+class StageTimer:
+    def __init__(self):
+        self.times: Dict[str, List[float]] = collections.defaultdict(list)
+        # Latencies of the frames that went through every stage
+        self.totals: List[float] = []
+        self._start = 0.0
+        self._last = 0.0
+
+    def start(self) -> None:
+        self._start = self._last = time.perf_counter()
+
+    def lap(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.times[stage].append(now - self._last)
+        self._last = now
+
+    def finish(self) -> None:
+        self.totals.append(self._last - self._start)
+
+
+def create_estimator(config) -> GazeEstimator:
+    if config.gaze_estimator.checkpoint:
+        return GazeEstimator(config)
+    print(f'No checkpoint for {config.model.name}, using random weights')
+    return GazeEstimator(config, model=create_model(config).eval())
+
+
+def run_frame(gaze_estimator: GazeEstimator, config, frame: np.ndarray,
+              track: FaceTrack, timer: StageTimer) -> bool:
+    """Runs one frame stage by stage, mirroring ``prepare_face`` and
+    ``Runner.finish``.
+
+    Returns False when not exactly one face is found.
+    """
+    timer.start()
+    frame = resize_frame(gaze_estimator, frame)
+    timer.lap('resize')
+    undistorted = gaze_estimator.undistort(frame)
+    timer.lap('undistort')
+
+    gray = to_gray(undistorted)
+    bboxes = gaze_estimator.find_faces(gray, track)
+    timer.lap('detect')
+    if len(bboxes) != 1:
+        return False
+    face = gaze_estimator.predict_landmarks(gray, bboxes)[0]
+    timer.lap('landmarks')
+
+    gaze_estimator.estimate_face_pose(face, track)
+    timer.lap('solvepnp')
+    gaze_estimator.normalize_images(undistorted, face, gray)
+    timer.lap('normalize')
+
+    images, head_poses = gaze_estimator.create_model_input(face)
+    timer.lap('model_input')
+    predictions = gaze_estimator.predict(images, head_poses)
+    timer.lap('forward')
+
+    gaze_estimator.apply_predictions(face, predictions)
+    if config.mode == GazeEstimationMethod.MPIIGaze.name:
+        error_to_center(eye_angles(face))
+    timer.lap('postprocess')
+    timer.finish()
+    return True
+
+
+def report(name: str, n_threads: int, timer: StageTimer, n_frames: int,
+           n_misses: int, elapsed: float) -> None:
+    print(f'\n{name}, {n_threads} threads: {n_frames} frames, '
+          f'{n_misses} without a single face, '
+          f'{n_frames / elapsed:.1f} frames/s')
+    print(f'{"stage":>12} {"mean":>7} {"p50":>7} {"p90":>7} {"p99":>7} '
+          f'{"max":>7}  (ms)')
+    for stage in STAGES:
+        times = np.array(timer.times.get(stage, [])) * 1e3
+        if times.size == 0:
+            continue
+        p50, p90, p99 = np.percentile(times, [50, 90, 99])
+        print(f'{stage:>12} {times.mean():>7.2f} {p50:>7.2f} {p90:>7.2f} '
+              f'{p99:>7.2f} {times.max():>7.2f}')
+    if timer.totals:
+        totals = np.array(timer.totals) * 1e3
+        p50, p90, p99 = np.percentile(totals, [50, 90, 99])
+        print(f'{"total":>12} {totals.mean():>7.2f} {p50:>7.2f} '
+              f'{p90:>7.2f} {p99:>7.2f} {totals.max():>7.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, required=True)
+    parser.add_argument('--input',
+                        type=str,
+                        default='images/test2.jpg',
+                        help='video, image or directory of images')
+    parser.add_argument('--max-frames', type=int, default=300)
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=1,
+                        help='number of times the frames are replayed')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--models',
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        help='defaults to the model of the config')
+    parser.add_argument('--threads',
+                        type=int,
+                        nargs='+',
+                        default=[1],
+                        help='torch and OpenCV thread counts to sweep')
+    parser.add_argument('options', default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    base_config = get_default_config()
+    base_config.merge_from_file(args.config)
+    base_config.merge_from_list(args.options)
+    if not torch.cuda.is_available():
+        base_config.device = 'cpu'
+
+    frames = list(iterate_frames(pathlib.Path(args.input), args.max_frames))
+    if not frames:
+        raise RuntimeError(f'No frames could be read from {args.input}')
+    frames = frames * args.repeat
+
+    for name in args.models or [base_config.model.name]:
+        config = base_config.clone()
+        if name != base_config.model.name:
+            config.model.name = name
+            config.gaze_estimator.checkpoint = ''
+        config.freeze()
+        gaze_estimator = create_estimator(config)
+
+        for n_threads in args.threads:
+            torch.set_num_threads(n_threads)
+            cv2.setNumThreads(n_threads)
+            for frame in frames[:args.warmup]:
+                run_frame(gaze_estimator, config, frame, FaceTrack(),
+                          StageTimer())
+
+            # The frames are replayed as a single stream
+            track = FaceTrack()
+            timer = StageTimer()
+            n_misses = 0
+            start = time.perf_counter()
+            for frame in frames:
+                if not run_frame(gaze_estimator, config, frame, track, timer):
+                    n_misses += 1
+            elapsed = time.perf_counter() - start
+            report(name, n_threads, timer, len(frames), n_misses, elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,42 @@
 
 import argparse
 
+import numpy as np
 import torch
 
 from gaze_estimation import create_model, get_default_config
+from gaze_estimation.models import create_example_inputs
+
+
+def create_inputs(config, n_faces: int, device: torch.device) -> tuple:
+    """Random model inputs for ``n_faces`` faces, see
+    ``create_example_inputs``."""
+    inputs = [create_example_inputs(config, device) for _ in range(n_faces)]
+    return tuple(torch.cat(tensors) for tensors in zip(*inputs))
+
+
+def check_parity(model: torch.nn.Module, config, path: str,
+                 tolerance: float) -> None:
+    """Compares the outputs of ONNX Runtime and torch on random inputs of
+    several batch sizes, which also checks the dynamic batch axis."""
+    import onnxruntime
+
+    session = onnxruntime.InferenceSession(path,
+                                           providers=['CPUExecutionProvider'])
+    model = model.cpu()
+    max_error = 0.0
+    for n_faces in (1, 2, 5):
+        data = create_inputs(config, n_faces, torch.device('cpu'))
+        with torch.no_grad():
+            expected = model(*data).numpy()
+        input_names = [node.name for node in session.get_inputs()]
+        feed = {name: x.numpy() for name, x in zip(input_names, data)}
+        actual = session.run(None, feed)[0]
+        max_error = max(max_error, float(np.abs(actual - expected).max()))
+    print(f'Max absolute difference with torch: {max_error:.2e}')
+    if max_error > tolerance:
+        raise RuntimeError(
+            f'The ONNX model differs from the checkpoint by {max_error:.2e}')
 
 
 def main():
@@ -12,10 +45,17 @@ def main():
     parser.add_argument('--config', type=str, required=True)
     parser.add_argument('--weight', type=str)
     parser.add_argument('--output-path', '-o', type=str, required=True)
+    parser.add_argument('--opset', type=int, default=13)
+    parser.add_argument('--check',
+                        action='store_true',
+                        help='compare the outputs with onnxruntime')
+    parser.add_argument('--tolerance', type=float, default=1e-4)
     args = parser.parse_args()
 
     config = get_default_config()
     config.merge_from_file(args.config)
+    if not torch.cuda.is_available():
+        config.device = 'cpu'
 
     device = torch.device(config.device)
 
@@ -25,17 +65,22 @@ def main():
         model.load_state_dict(checkpoint['model'])
     model.eval()
 
-    if config.mode == 'MPIIGaze':
-        x = torch.zeros((1, 1, 36, 60), dtype=torch.float32, device=device)
-        y = torch.zeros((1, 2), dtype=torch.float32, device=device)
-        data = (x, y)
-    elif config.mode == 'MPIIFaceGaze':
-        x = torch.zeros((1, 3, 224, 224), dtype=torch.float32, device=device)
-        data = (x, )
-    else:
-        raise ValueError
-
-    torch.onnx.export(model, data, args.output_path)
+    data = create_example_inputs(config, device)
+    # The inputs are named after the arguments of the models' forward,
+    # and the batch dimension is left free so that the server can batch
+    # frames
+    input_names = ['image', 'head_pose'][:len(data)]
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + ['gaze']}
+    torch.onnx.export(model,
+                      data,
+                      args.output_path,
+                      input_names=input_names,
+                      output_names=['gaze'],
+                      dynamic_axes=dynamic_axes,
+                      opset_version=args.opset)
+
+    if args.check:
+        check_parity(model, config, args.output_path, args.tolerance)
 
 
 if __name__ == '__main__':
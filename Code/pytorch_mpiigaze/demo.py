@@ -12,6 +12,7 @@ import yacs.config
 from gaze_estimation import GazeEstimationMethod, GazeEstimator
 from gaze_estimation.gaze_estimator.common import (Face, FacePartsName,
                                                    Visualizer)
+from gaze_estimation.gaze_estimator.head_pose_estimation import to_gray
 from gaze_estimation.utils import load_config
 
 logging.basicConfig(level=logging.INFO)
@@ -48,14 +49,13 @@ class Demo:
             if not ok:
                 break
 
-            undistorted = cv2.undistort(
-                frame, self.gaze_estimator.camera.camera_matrix,
-                self.gaze_estimator.camera.dist_coefficients)
+            undistorted = self.gaze_estimator.undistort(frame)
 
             self.visualizer.set_image(frame.copy())
-            faces = self.gaze_estimator.detect_faces(undistorted)
+            gray = to_gray(undistorted)
+            faces = self.gaze_estimator.detect_faces(undistorted, gray=gray)
             for face in faces:
-                self.gaze_estimator.estimate_gaze(undistorted, face)
+                self.gaze_estimator.estimate_gaze(undistorted, face, gray)
                 self._draw_face_bbox(face)
                 self._draw_head_pose(face)
                 self._draw_landmarks(face)
@@ -1,11 +1,25 @@
+import importlib
+
 from .config import get_default_config
-from .dataloader import create_dataloader
 from .gaze_estimator import GazeEstimator
 from .logger import create_logger
-from .losses import create_loss
-from .models import create_model
-from .optim import create_optimizer
-from .scheduler import create_scheduler
-from .tensorboard import create_tensorboard_writer
-from .transforms import create_transform
 from .types import GazeEstimationMethod, LossType
+
+# These need torch, which is only imported when one of them is first
+# used, so that inference with the ONNX Runtime backend does without it
+_TORCH_FUNCTIONS = {
+    'create_dataloader': '.dataloader',
+    'create_loss': '.losses',
+    'create_model': '.models',
+    'create_optimizer': '.optim',
+    'create_scheduler': '.scheduler',
+    'create_tensorboard_writer': '.tensorboard',
+    'create_transform': '.transforms',
+}
+
+
+def __getattr__(name: str):
+    if name in _TORCH_FUNCTIONS:
+        module = importlib.import_module(_TORCH_FUNCTIONS[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
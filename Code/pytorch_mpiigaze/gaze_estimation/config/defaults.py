@@ -91,6 +91,21 @@ config.face_detector = ConfigNode()
 config.face_detector.mode = 'dlib'
 config.face_detector.dlib = ConfigNode()
 config.face_detector.dlib.model = 'data/dlib/shape_predictor_68_face_landmarks.dat'
+# Run the face detector on a grayscale copy of the frame downscaled by
+# this factor (1 disables it), landmarks are still predicted on the full
+# frame. The detector misses faces smaller than about 80 pixels in the
+# downscaled frame, so 2 suits a 640x480 webcam at arm's length.
+config.face_detector.downscale = 1
+# Follow the face of a video stream instead of searching the whole frame.
+# The frontal face detector runs on the whole frame every detect_every
+# frames, and in between only on the previous face box enlarged by
+# roi_padding (relative to the box size). The whole frame is searched
+# again as soon as the face is not found there with at least min_score.
+config.face_detector.tracking = ConfigNode()
+config.face_detector.tracking.enabled = False
+config.face_detector.tracking.detect_every = 10
+config.face_detector.tracking.roi_padding = 0.5
+config.face_detector.tracking.min_score = 0.3
 
 # Gaze estimator
 config.gaze_estimator = ConfigNode()
@@ -98,6 +113,53 @@ config.gaze_estimator.checkpoint = ''
 config.gaze_estimator.camera_params = ''
 config.gaze_estimator.normalized_camera_params = 'data/calib/normalized_camera_params_eye.yaml'
 config.gaze_estimator.normalized_camera_distance = 0.6
+# Runtime of the gaze model (options: torch, onnxruntime). With
+# onnxruntime, torch is not imported at all and the model exported by
+# convert_to_onnx.py is loaded from onnx.model, which defaults to the
+# checkpoint path with the .onnx suffix. The thread counts are those of a
+# single forward pass, 0 lets ONNX Runtime use every core.
+config.gaze_estimator.backend = 'torch'
+# Preparation of the model of the torch backend (options: '', trace,
+# script, compile). With trace or script, the TorchScript graph is frozen
+# and optimized for inference, and saved next to the checkpoint, from
+# where later starts load it until the checkpoint changes. With compile,
+# the model goes through torch.compile and the compiled kernels are
+# cached in torch_compile_cache next to the checkpoint.
+config.gaze_estimator.jit = ConfigNode()
+config.gaze_estimator.jit.mode = ''
+# Inference preparation of the model of the torch backend, checked to give
+# the same outputs: fold the batch norms into the convolutions before
+# them, and convert the model and its inputs to the channels-last memory
+# format, which suits the oneDNN convolutions of the CPU.
+config.gaze_estimator.fuse_batch_norms = False
+config.gaze_estimator.channels_last = False
+# TorchScript model loaded instead of the checkpoint by the torch backend,
+# such as the INT8 models written by tools/quantize_model.py, which need
+# device: cpu.
+config.gaze_estimator.torchscript_model = ''
+config.gaze_estimator.onnx = ConfigNode()
+config.gaze_estimator.onnx.model = ''
+config.gaze_estimator.onnx.intra_op_threads = 1
+config.gaze_estimator.onnx.inter_op_threads = 1
+# How the lens distortion is removed. With 'image', every frame is
+# undistorted before the face detection. With 'landmarks', faces are
+# detected on the raw frame, solvePnP undistorts the landmarks and the
+# distortion is folded into the warp of the normalized images, which
+# avoids a full frame remap per frame.
+config.gaze_estimator.undistortion = 'image'
+# Head pose of a video stream. With warm_start, solvePnP starts from the
+# head pose of the previous frame when it is at most max_age seconds old.
+# With smoothing, the landmarks are filtered over time with a One-Euro
+# filter: min_cutoff (Hz) sets the smoothing of a still face and beta how
+# quickly it gives way when the face moves.
+config.gaze_estimator.head_pose = ConfigNode()
+config.gaze_estimator.head_pose.warm_start = True
+config.gaze_estimator.head_pose.max_age = 0.5
+config.gaze_estimator.head_pose.smoothing = ConfigNode()
+config.gaze_estimator.head_pose.smoothing.enabled = False
+config.gaze_estimator.head_pose.smoothing.min_cutoff = 1.0
+config.gaze_estimator.head_pose.smoothing.beta = 0.01
+config.gaze_estimator.head_pose.smoothing.d_cutoff = 1.0
 
 # demo
 config.demo = ConfigNode()
@@ -115,6 +177,35 @@ config.demo.show_landmarks = True
 config.demo.show_normalized_image = False
 config.demo.show_template_model = False
 
+# gaze server
+config.server = ConfigNode()
+config.server.host = '127.0.0.1'
+config.server.port = 5004
+# Ask clients to send grayscale frames in MPIIGaze mode
+config.server.grayscale_transport = True
+# Number of frames of a single client that are processed at once
+config.server.max_frames_in_flight = 4
+# Workers running face detection, landmarks and normalization
+# (options: thread, process). Use processes to scale with the number
+# of cores. Each process tracks the faces of the clients sent to it, so
+# all the frames of a client go to the same process and a single client
+# never uses more than one core.
+config.server.face_workers = ConfigNode()
+config.server.face_workers.type = 'thread'
+config.server.face_workers.num_workers = 1
+# Run the gaze model once for the frames of all the clients collected
+# within max_delay_ms, or as soon as max_batch_size samples (eyes in
+# MPIIGaze mode) are ready
+config.server.batching = ConfigNode()
+config.server.batching.enabled = False
+config.server.batching.max_batch_size = 64
+config.server.batching.max_delay_ms = 5.0
+# Prometheus metrics served at http://host:port/metrics
+config.server.metrics = ConfigNode()
+config.server.metrics.enabled = True
+config.server.metrics.host = '127.0.0.1'
+config.server.metrics.port = 5005
+
 # cuDNN
 config.cudnn = ConfigNode()
 config.cudnn.benchmark = True
@@ -3,4 +3,6 @@ from .eye import Eye
 from .face import Face
 from .face_model import MODEL3D
 from .face_parts import FaceParts, FacePartsName
+from .face_track import FaceTrack, FaceTracks
+from .one_euro_filter import OneEuroFilter
 from .visualizer import Visualizer
@@ -1,5 +1,5 @@
 import dataclasses
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
 import cv2
 import numpy as np
@@ -14,6 +14,16 @@ class Camera:
     dist_coefficients: np.ndarray = dataclasses.field(init=False)
 
     camera_params_path: dataclasses.InitVar[str] = None
+    # Fixed-point maps are what cv2.undistort uses internally, and are
+    # faster to remap with than floating-point ones
+    fixed_point_maps: bool = True
+    # (width, height) -> undistortion maps of that resolution
+    _undistort_maps: Dict[Tuple[int, int],
+                          Tuple[np.ndarray, np.ndarray]] = dataclasses.field(
+                              init=False,
+                              default_factory=dict,
+                              repr=False,
+                              compare=False)
 
     def __post_init__(self, camera_params_path):
         with open(camera_params_path) as f:
@@ -25,6 +35,29 @@ class Camera:
         self.dist_coefficients = np.array(
             data['distortion_coefficients']['data']).reshape(-1, 1)
 
+    @property
+    def has_distortion(self) -> bool:
+        return bool(np.any(self.dist_coefficients))
+
+    def undistort(self, image: np.ndarray) -> np.ndarray:
+        """Same as ``cv2.undistort``, with the undistortion maps computed once
+        per image resolution.
+
+        ``image`` itself is returned when the camera has no distortion.
+        """
+        if not self.has_distortion:
+            return image
+        size = (image.shape[1], image.shape[0])
+        maps = self._undistort_maps.get(size)
+        if maps is None:
+            map_type = cv2.CV_16SC2 if self.fixed_point_maps else cv2.CV_32FC1
+            maps = cv2.initUndistortRectifyMap(self.camera_matrix,
+                                               self.dist_coefficients, None,
+                                               self.camera_matrix, size,
+                                               map_type)
+            self._undistort_maps[size] = maps
+        return cv2.remap(image, maps[0], maps[1], cv2.INTER_LINEAR)
+
     def project_points(self,
                        points3d: np.ndarray,
                        rvec: Optional[np.ndarray] = None,
@@ -1,4 +1,5 @@
 import dataclasses
+from typing import Optional
 
 import cv2
 import numpy as np
@@ -106,16 +107,29 @@ class FaceModel:
     CHIN_INDEX: int = 8
     NOSE_INDEX: int = 30
 
-    def estimate_head_pose(self, face: Face, camera: Camera) -> None:
-        """Estimate the head pose by fitting 3D template model."""
+    def estimate_head_pose(self,
+                           face: Face,
+                           camera: Camera,
+                           rvec: Optional[np.ndarray] = None,
+                           tvec: Optional[np.ndarray] = None) -> None:
+        """Estimate the head pose by fitting 3D template model.
+
+        ``rvec`` and ``tvec`` are the initial guess, e.g. the head pose
+        of the previous frame of a video.
+        """
         # If the number of the template points is small, cv2.solvePnP
         # becomes unstable, so set the default value for rvec and tvec
         # and set useExtrinsicGuess to True.
         # The default values of rvec and tvec below mean that the
         # initial estimate of the head pose is not rotated and the
         # face is in front of the camera.
-        rvec = np.zeros(3, dtype=float)
-        tvec = np.array([0, 0, 1], dtype=float)
+        if rvec is None or tvec is None:
+            rvec = np.zeros(3, dtype=float)
+            tvec = np.array([0, 0, 1], dtype=float)
+        else:
+            # solvePnP refines the guess in place
+            rvec = rvec.astype(float).ravel()
+            tvec = tvec.astype(float).ravel()
         _, rvec, tvec = cv2.solvePnP(self.LANDMARKS,
                                      face.landmarks,
                                      camera.camera_matrix,
@@ -0,0 +1,48 @@
+import collections
+import threading
+from typing import Hashable, Optional
+
+import dlib
+import numpy as np
+
+from .one_euro_filter import OneEuroFilter
+
+
+class FaceTrack:
+    """State kept between the frames of one video stream.
+
+    Frames of a stream may be processed by several threads at once, so
+    the state must only be read and updated with ``lock`` held.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Face found by the last detection, None when there was not
+        # exactly one face
+        self.bbox: Optional[dlib.rectangle] = None
+        self.frames_since_detection = 0
+        # Head pose of the last frame, used as the initial guess of the
+        # next one
+        self.rvec: Optional[np.ndarray] = None
+        self.tvec: Optional[np.ndarray] = None
+        self.pose_time = 0.0
+        self.landmark_filter: Optional[OneEuroFilter] = None
+
+
+class FaceTracks:
+    """The tracks of the most recently seen streams."""
+    def __init__(self, max_tracks: int = 64):
+        self.max_tracks = max_tracks
+        self._tracks: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, stream_id: Hashable) -> FaceTrack:
+        with self._lock:
+            track = self._tracks.get(stream_id)
+            if track is None:
+                track = FaceTrack()
+                self._tracks[stream_id] = track
+                if len(self._tracks) > self.max_tracks:
+                    self._tracks.popitem(last=False)
+            else:
+                self._tracks.move_to_end(stream_id)
+            return track
@@ -0,0 +1,51 @@
+import math
+from typing import Optional
+
+import numpy as np
+
+
+class OneEuroFilter:
+    """Speed-adaptive low-pass filter of Casiez et al., CHI 2012.
+
+    Slow movements are smoothed with a cutoff frequency close to
+    ``min_cutoff`` (Hz), which removes jitter, and the cutoff grows by
+    ``beta`` times the speed so that fast movements are followed with
+    little lag. Every element of the filtered array is filtered
+    independently.
+    """
+    def __init__(self,
+                 min_cutoff: float = 1.0,
+                 beta: float = 0.0,
+                 d_cutoff: float = 1.0):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self._x: Optional[np.ndarray] = None
+        self._dx: Optional[np.ndarray] = None
+        self._t = 0.0
+
+    @staticmethod
+    def _alpha(dt: float, cutoff):
+        tau = 1 / (2 * math.pi * cutoff)
+        return 1 / (1 + tau / dt)
+
+    def __call__(self, x: np.ndarray, t: float) -> np.ndarray:
+        """Filters the value ``x`` observed at time ``t`` (seconds).
+
+        A value observed before the last one is returned unfiltered and
+        leaves the state of the filter untouched.
+        """
+        if self._x is None:
+            self._x = x.astype(np.float64)
+            self._dx = np.zeros_like(self._x)
+            self._t = t
+            return self._x.copy()
+        dt = t - self._t
+        if dt <= 0:
+            return x.astype(np.float64)
+        dx = (x - self._x) / dt
+        self._dx += self._alpha(dt, self.d_cutoff) * (dx - self._dx)
+        cutoff = self.min_cutoff + self.beta * np.abs(self._dx)
+        self._x += self._alpha(dt, cutoff) * (x - self._x)
+        self._t = t
+        return self._x.copy()
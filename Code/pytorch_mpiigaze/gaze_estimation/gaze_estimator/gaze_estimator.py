@@ -1,15 +1,17 @@
 import logging
-from typing import List
+import os
+import pathlib
+import time
+from typing import Any, List, Optional, Tuple
 
 import numpy as np
-import torch
 import yacs.config
 
-from ..models import create_model
-from ..transforms import create_transform
 from ..types import GazeEstimationMethod
-from .common import MODEL3D, Camera, Face, FacePartsName
+from .common import (MODEL3D, Camera, Face, FacePartsName, FaceTrack,
+                     OneEuroFilter)
 from .head_pose_estimation import HeadPoseNormalizer, LandmarkEstimator
+from .input_transform import create_input_transform
 
 logger = logging.getLogger(__name__)
 
@@ -17,87 +19,346 @@ logger = logging.getLogger(__name__)
 class GazeEstimator:
     EYE_KEYS = [FacePartsName.REYE, FacePartsName.LEYE]
 
-    def __init__(self, config: yacs.config.CfgNode):
+    def __init__(self,
+                 config: yacs.config.CfgNode,
+                 load_model: bool = True,
+                 model: Optional[Any] = None):
+        """``model`` is a torch gaze model used instead of loading the
+        checkpoint of the config, e.g. one with random weights."""
         self._config = config
 
         self.camera = Camera(config.gaze_estimator.camera_params)
         self._normalized_camera = Camera(
             config.gaze_estimator.normalized_camera_params)
 
+        self._undistortion = config.gaze_estimator.undistortion
+        if self._undistortion not in ('image', 'landmarks'):
+            raise ValueError(f'Unknown undistortion mode {self._undistortion}')
+
         self._landmark_estimator = LandmarkEstimator(config)
         self._head_pose_normalizer = HeadPoseNormalizer(
             self.camera, self._normalized_camera,
-            self._config.gaze_estimator.normalized_camera_distance)
-        self._gaze_estimation_model = self._load_model()
-        self._transform = create_transform(config)
+            self._config.gaze_estimator.normalized_camera_distance,
+            distorted_images=self._undistortion == 'landmarks')
+        self._backend = config.gaze_estimator.backend
+        self._channels_last = config.gaze_estimator.channels_last
+        if self._backend not in ('torch', 'onnxruntime'):
+            raise ValueError(f'Unknown backend {self._backend}')
+        # Without the model, only the steps up to create_model_input can
+        # be used, which is all the face pipeline workers need.
+        self._gaze_estimation_model = None
+        self._onnx_session = None
+        if model is not None:
+            self._gaze_estimation_model = model
+        elif load_model:
+            if self._backend == 'torch':
+                self._gaze_estimation_model = self._load_model()
+            else:
+                self._onnx_session = self._load_onnx_session()
+        self._transform = create_input_transform(config)
+
+    def _load_model(self) -> Any:
+        # torch is only needed by this backend
+        import torch
+
+        from ..models import create_model, prepare_for_inference
+
+        torchscript_path = self._config.gaze_estimator.torchscript_model
+        if torchscript_path:
+            model = torch.jit.load(torchscript_path,
+                                   map_location=self._config.device)
+            model.eval()
+            logger.info(f'Loaded {torchscript_path}')
+            return model
+
+        jit_mode = self._config.gaze_estimator.jit.mode
+        if jit_mode not in ('', 'trace', 'script', 'compile'):
+            raise ValueError(f'Unknown jit mode {jit_mode}')
+        checkpoint_path = pathlib.Path(self._config.gaze_estimator.checkpoint)
+        device = torch.device(self._config.device)
+
+        if jit_mode in ('trace', 'script'):
+            cache_path = checkpoint_path.with_name(
+                f'{checkpoint_path.stem}.{jit_mode}.{device.type}'
+                f'{".nhwc" if self._channels_last else ""}'
+                f'.torch-{torch.__version__}.pt')
+            if (cache_path.exists() and cache_path.stat().st_mtime >=
+                    checkpoint_path.stat().st_mtime):
+                model = torch.jit.load(str(cache_path), map_location=device)
+                logger.info(f'Loaded {cache_path}')
+                self._warm_up(model)
+                return model
 
-    def _load_model(self) -> torch.nn.Module:
         model = create_model(self._config)
-        checkpoint = torch.load(self._config.gaze_estimator.checkpoint,
-                                map_location='cpu')
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
         model.load_state_dict(checkpoint['model'])
-        model.to(torch.device(self._config.device))
+        model.to(device)
         model.eval()
+        # The copy prepared for inference is also the one TorchScript can
+        # compile
+        if (self._config.gaze_estimator.fuse_batch_norms or self._channels_last
+                or jit_mode in ('trace', 'script')):
+            model = prepare_for_inference(
+                model,
+                self._config,
+                fuse=self._config.gaze_estimator.fuse_batch_norms,
+                channels_last=self._channels_last)
+
+        if jit_mode in ('trace', 'script'):
+            with torch.no_grad():
+                if jit_mode == 'trace':
+                    model = torch.jit.trace(model, self._example_inputs())
+                else:
+                    model = torch.jit.script(model)
+                # Freezing inlines the weights, which lets
+                # optimize_for_inference fold the batch norms into the
+                # convolutions and fuse the activations
+                model = torch.jit.optimize_for_inference(
+                    torch.jit.freeze(model))
+            # Written under another name first, as several processes may
+            # start at once
+            temporary_path = cache_path.with_name(f'{cache_path.name}.tmp')
+            torch.jit.save(model, str(temporary_path))
+            temporary_path.replace(cache_path)
+            logger.info(f'Saved the TorchScript model to {cache_path}')
+        elif jit_mode == 'compile':
+            # The kernels compiled by inductor are kept next to the
+            # checkpoint, so that later starts only have to load them
+            os.environ.setdefault(
+                'TORCHINDUCTOR_CACHE_DIR',
+                str(checkpoint_path.parent / 'torch_compile_cache'))
+            import torch._inductor.config
+            torch._inductor.config.fx_graph_cache = True
+            model = torch.compile(model)
+        if jit_mode:
+            self._warm_up(model)
         return model
 
-    def detect_faces(self, image: np.ndarray) -> List[Face]:
-        return self._landmark_estimator.detect_faces(image)
+    def _example_inputs(self) -> tuple:
+        import torch
+
+        from ..models import create_example_inputs, to_memory_format
+
+        inputs = create_example_inputs(self._config,
+                                       torch.device(self._config.device))
+        return to_memory_format(inputs, self._channels_last)
+
+    def _warm_up(self, model: Any) -> None:
+        """Runs the model a few times, since TorchScript optimizes the graph
+        and torch.compile compiles it on the first calls, which would otherwise
+        delay the first frames."""
+        import torch
+
+        inputs = self._example_inputs()
+        with torch.no_grad():
+            for _ in range(3):
+                model(*inputs)
+
+    def _load_onnx_session(self) -> Any:
+        import onnxruntime
+
+        config = self._config.gaze_estimator.onnx
+        path = config.model
+        if not path:
+            path = pathlib.Path(
+                self._config.gaze_estimator.checkpoint).with_suffix('.onnx')
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = config.intra_op_threads
+        options.inter_op_num_threads = config.inter_op_threads
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL)
+        providers = ['CPUExecutionProvider']
+        available_providers = onnxruntime.get_available_providers()
+        if (self._config.device.startswith('cuda')
+                and 'CUDAExecutionProvider' in available_providers):
+            providers.insert(0, 'CUDAExecutionProvider')
+        session = onnxruntime.InferenceSession(str(path),
+                                               options,
+                                               providers=providers)
+        logger.info(f'Loaded {path} with {session.get_providers()[0]}')
+        return session
+
+    def undistort(self, image: np.ndarray) -> np.ndarray:
+        """Returns the image the faces are detected and normalized on, which is
+        the raw frame when only the landmarks are undistorted."""
+        if self._undistortion == 'image':
+            return self.camera.undistort(image)
+        return image
+
+    def detect_faces(self,
+                     image: np.ndarray,
+                     track: Optional[FaceTrack] = None,
+                     gray: Optional[np.ndarray] = None) -> List[Face]:
+        return self._landmark_estimator.detect_faces(image, track, gray)
+
+    def find_faces(self,
+                   gray: np.ndarray,
+                   track: Optional[FaceTrack] = None) -> List[Any]:
+        """Returns the face boxes of a grayscale image, the first step of
+        :meth:`detect_faces`."""
+        return self._landmark_estimator.find_bboxes(gray, track)
+
+    def predict_landmarks(self, gray: np.ndarray,
+                          bboxes: List[Any]) -> List[Face]:
+        """Returns the faces of the boxes found by :meth:`find_faces`, the
+        second step of :meth:`detect_faces`."""
+        return self._landmark_estimator.predict_landmarks(gray, bboxes)
 
-    def estimate_gaze(self, image: np.ndarray, face: Face) -> None:
-        MODEL3D.estimate_head_pose(face, self.camera)
+    def estimate_gaze(self,
+                      image: np.ndarray,
+                      face: Face,
+                      gray: Optional[np.ndarray] = None) -> None:
+        self.normalize(image, face, gray=gray)
+        images, head_poses = self.create_model_input(face)
+        predictions = self.predict(images, head_poses)
+        self.apply_predictions(face, predictions)
+
+    def normalize(self,
+                  image: np.ndarray,
+                  face: Face,
+                  track: Optional[FaceTrack] = None,
+                  gray: Optional[np.ndarray] = None,
+                  timestamp: Optional[float] = None) -> None:
+        """Estimate the head pose and compute the normalized images, see
+        :meth:`estimate_face_pose` and :meth:`normalize_images`."""
+        self.estimate_face_pose(face, track, timestamp)
+        self.normalize_images(image, face, gray)
+
+    def estimate_face_pose(self,
+                           face: Face,
+                           track: Optional[FaceTrack] = None,
+                           timestamp: Optional[float] = None) -> None:
+        """Estimate the head pose, then the 3D landmarks and the face and eye
+        centers."""
+        self.estimate_head_pose(face, track, timestamp)
         MODEL3D.compute_3d_pose(face)
         MODEL3D.compute_face_eye_centers(face)
 
+    def normalize_images(self,
+                         image: np.ndarray,
+                         face: Face,
+                         gray: Optional[np.ndarray] = None) -> None:
+        """Compute the normalized images of a face whose pose is known.
+
+        The eye images are grayscale, so they are warped from ``gray``,
+        the grayscale version of ``image``, when it is given.
+        """
+        if self._config.mode == GazeEstimationMethod.MPIIGaze.name:
+            eyes = [getattr(face, key.name.lower()) for key in self.EYE_KEYS]
+            self._head_pose_normalizer.normalize_many(
+                image if gray is None else gray, eyes)
+        elif self._config.mode == GazeEstimationMethod.MPIIFaceGaze.name:
+            self._head_pose_normalizer.normalize(image, face)
+
+    def estimate_head_pose(self,
+                           face: Face,
+                           track: Optional[FaceTrack] = None,
+                           timestamp: Optional[float] = None) -> None:
+        """With ``track``, the head pose of the previous frame of the stream is
+        the initial guess, and the landmarks can be smoothed over time, see
+        ``gaze_estimator.head_pose`` in the config.
+
+        ``timestamp`` is the capture time of the frame in seconds since
+        the epoch, it defaults to now. Frames may be processed out of
+        order, so the capture time is what the filter must see.
+        """
+        if track is None:
+            MODEL3D.estimate_head_pose(face, self.camera)
+            return
+
+        config = self._config.gaze_estimator.head_pose
+        now = time.time() if timestamp is None else timestamp
+        rvec = tvec = None
+        with track.lock:
+            recent = abs(now - track.pose_time) <= config.max_age
+            if config.smoothing.enabled:
+                if track.landmark_filter is None or not recent:
+                    track.landmark_filter = OneEuroFilter(
+                        config.smoothing.min_cutoff, config.smoothing.beta,
+                        config.smoothing.d_cutoff)
+                face.landmarks = track.landmark_filter(face.landmarks, now)
+            if config.warm_start and recent:
+                rvec, tvec = track.rvec, track.tvec
+        MODEL3D.estimate_head_pose(face, self.camera, rvec, tvec)
+        with track.lock:
+            # The pose of a frame that arrived late does not replace the
+            # pose of a newer one
+            if now >= track.pose_time:
+                track.rvec = face.head_pose_rot.as_rotvec()
+                track.tvec = face.head_position.ravel().copy()
+                track.pose_time = now
+
+    def create_model_input(
+            self, face: Face) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Returns the model input for a normalized face.
+
+        The first dimension of the returned arrays is the batch
+        dimension, so the inputs of several faces can be concatenated
+        and passed to :meth:`predict` at once. The head poses are None
+        in MPIIFaceGaze mode.
+        """
         if self._config.mode == GazeEstimationMethod.MPIIGaze.name:
+            images = []
+            head_poses = []
             for key in self.EYE_KEYS:
                 eye = getattr(face, key.name.lower())
-                self._head_pose_normalizer.normalize(image, eye)
-            self._run_mpiigaze_model(face)
+                image = eye.normalized_image
+                normalized_head_pose = eye.normalized_head_rot2d
+                if key == FacePartsName.REYE:
+                    image = image[:, ::-1]
+                    normalized_head_pose *= np.array([1, -1])
+                image = self._transform(image)
+                images.append(image)
+                head_poses.append(normalized_head_pose)
+            images = np.stack(images)
+            head_poses = np.array(head_poses).astype(np.float32)
+            return images, head_poses
         elif self._config.mode == GazeEstimationMethod.MPIIFaceGaze.name:
-            self._head_pose_normalizer.normalize(image, face)
-            self._run_mpiifacegaze_model(face)
-
-    def _run_mpiigaze_model(self, face: Face) -> None:
-        images = []
-        head_poses = []
-        for key in self.EYE_KEYS:
-            eye = getattr(face, key.name.lower())
-            image = eye.normalized_image
-            normalized_head_pose = eye.normalized_head_rot2d
-            if key == FacePartsName.REYE:
-                image = image[:, ::-1]
-                normalized_head_pose *= np.array([1, -1])
-            image = self._transform(image)
-            images.append(image)
-            head_poses.append(normalized_head_pose)
-        images = torch.stack(images)
-        head_poses = np.array(head_poses).astype(np.float32)
-        head_poses = torch.from_numpy(head_poses)
+            image = self._transform(face.normalized_image)[None]
+            return image, None
+        else:
+            raise ValueError
 
-        device = torch.device(self._config.device)
-        with torch.no_grad():
-            images = images.to(device)
-            head_poses = head_poses.to(device)
-            predictions = self._gaze_estimation_model(images, head_poses)
-            predictions = predictions.cpu().numpy()
-
-        for i, key in enumerate(self.EYE_KEYS):
-            eye = getattr(face, key.name.lower())
-            eye.normalized_gaze_angles = predictions[i]
-            if key == FacePartsName.REYE:
-                eye.normalized_gaze_angles *= np.array([1, -1])
-            eye.angle_to_vector()
-            eye.denormalize_gaze_vector()
-
-    def _run_mpiifacegaze_model(self, face: Face) -> None:
-        image = self._transform(face.normalized_image).unsqueeze(0)
+    def predict(self,
+                images: np.ndarray,
+                head_poses: Optional[np.ndarray] = None) -> np.ndarray:
+        if self._onnx_session is not None:
+            return self._predict_onnx(images, head_poses)
+        import torch
 
         device = torch.device(self._config.device)
         with torch.no_grad():
-            image = image.to(device)
-            prediction = self._gaze_estimation_model(image)
-            prediction = prediction.cpu().numpy()
+            images = torch.from_numpy(images).to(device)
+            if self._channels_last:
+                images = images.contiguous(memory_format=torch.channels_last)
+            if head_poses is None:
+                predictions = self._gaze_estimation_model(images)
+            else:
+                head_poses = torch.from_numpy(head_poses).to(device)
+                predictions = self._gaze_estimation_model(images, head_poses)
+            return predictions.cpu().numpy()
 
-        face.normalized_gaze_angles = prediction[0]
-        face.angle_to_vector()
-        face.denormalize_gaze_vector()
+    def _predict_onnx(self, images: np.ndarray,
+                      head_poses: Optional[np.ndarray]) -> np.ndarray:
+        # The inputs are in the order of the arguments of the model's
+        # forward, see convert_to_onnx.py
+        inputs = self._onnx_session.get_inputs()
+        feed = {inputs[0].name: images}
+        if head_poses is not None:
+            feed[inputs[1].name] = head_poses
+        return self._onnx_session.run(None, feed)[0]
+
+    def apply_predictions(self, face: Face, predictions: np.ndarray) -> None:
+        if self._config.mode == GazeEstimationMethod.MPIIGaze.name:
+            for i, key in enumerate(self.EYE_KEYS):
+                eye = getattr(face, key.name.lower())
+                eye.normalized_gaze_angles = predictions[i]
+                if key == FacePartsName.REYE:
+                    eye.normalized_gaze_angles *= np.array([1, -1])
+                eye.angle_to_vector()
+                eye.denormalize_gaze_vector()
+        elif self._config.mode == GazeEstimationMethod.MPIIFaceGaze.name:
+            face.normalized_gaze_angles = predictions[0]
+            face.angle_to_vector()
+            face.denormalize_gaze_vector()
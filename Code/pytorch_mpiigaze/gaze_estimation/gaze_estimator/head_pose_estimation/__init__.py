@@ -1,2 +1,2 @@
-from .face_landmark_estimator import LandmarkEstimator
+from .face_landmark_estimator import LandmarkEstimator, to_gray
 from .head_pose_normalizer import HeadPoseNormalizer
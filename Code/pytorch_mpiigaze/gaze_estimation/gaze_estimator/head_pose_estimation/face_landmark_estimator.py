@@ -1,33 +1,79 @@
-from typing import List
+import threading
+from typing import List, Optional, Tuple
 
+import cv2
 import dlib
 import numpy as np
 import yacs.config
 
-from ..common import Face
+from ..common import Face, FaceTrack
+
+
+def to_gray(image: np.ndarray) -> np.ndarray:
+    """Returns a contiguous grayscale version of a BGR or grayscale image."""
+    if image.ndim == 2:
+        return np.ascontiguousarray(image)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
 
 class LandmarkEstimator:
     def __init__(self, config: yacs.config.CfgNode):
         self.mode = config.face_detector.mode
         if self.mode == 'dlib':
-            self.detector = dlib.get_frontal_face_detector()
+            # The dlib detector must not be shared between threads, so
+            # each thread gets its own. The predictor is safe to share.
+            self._local = threading.local()
             self.predictor = dlib.shape_predictor(
                 config.face_detector.dlib.model)
         else:
             raise ValueError
+        self.downscale = config.face_detector.downscale
+        tracking_config = config.face_detector.tracking
+        self.tracking = tracking_config.enabled
+        self.detect_every = tracking_config.detect_every
+        self.roi_padding = tracking_config.roi_padding
+        self.min_score = tracking_config.min_score
+
+    @property
+    def detector(self) -> dlib.fhog_object_detector:
+        detector = getattr(self._local, 'detector', None)
+        if detector is None:
+            detector = dlib.get_frontal_face_detector()
+            self._local.detector = detector
+        return detector
 
-    def detect_faces(self, image: np.ndarray) -> List[Face]:
+    def detect_faces(self,
+                     image: np.ndarray,
+                     track: Optional[FaceTrack] = None,
+                     gray: Optional[np.ndarray] = None) -> List[Face]:
+        """Detects the faces and their landmarks. With tracking enabled, the
+        faces of consecutive frames of the stream followed by ``track`` are
+        searched near the previous one.
+
+        ``gray`` is the grayscale version of ``image``. It is computed
+        when not given, pass it when the caller needs it too.
+        """
         if self.mode == 'dlib':
-            return self._detect_faces_dlib(image)
+            if gray is None:
+                gray = to_gray(image)
+            return self._detect_faces_dlib(gray, track)
         else:
             raise ValueError
 
-    def _detect_faces_dlib(self, image: np.ndarray) -> List[Face]:
-        bboxes = self.detector(image[:, :, ::-1], 0)
+    def _detect_faces_dlib(self, gray: np.ndarray,
+                           track: Optional[FaceTrack]) -> List[Face]:
+        # The detector and every landmark prediction share the same
+        # contiguous buffer, so that dlib does not copy the frame. The
+        # landmarks are always predicted at full resolution.
+        return self.predict_landmarks(gray, self.find_bboxes(gray, track))
+
+    def predict_landmarks(self, gray: np.ndarray,
+                          bboxes: List[dlib.rectangle]) -> List[Face]:
+        """Returns the faces in ``bboxes``, as found by
+        :meth:`find_bboxes`, with their landmarks."""
         detected = []
         for bbox in bboxes:
-            predictions = self.predictor(image[:, :, ::-1], bbox)
+            predictions = self.predictor(gray, bbox)
             landmarks = np.array([(pt.x, pt.y) for pt in predictions.parts()],
                                  dtype=np.float64)
             bbox = np.array([[bbox.left(), bbox.top()],
@@ -35,3 +81,80 @@ class LandmarkEstimator:
                             dtype=np.float64)
             detected.append(Face(bbox, landmarks))
         return detected
+
+    def find_bboxes(self,
+                    image: np.ndarray,
+                    track: Optional[FaceTrack] = None) -> List[dlib.rectangle]:
+        """Returns the face boxes of a BGR or grayscale image."""
+        if track is None or not self.tracking:
+            return self._detect(image)[0]
+
+        with track.lock:
+            previous = track.bbox
+            due = track.frames_since_detection >= self.detect_every
+            track.frames_since_detection += 1
+        if previous is not None and not due:
+            bbox = self._find_bbox_near(image, previous)
+            if bbox is not None:
+                with track.lock:
+                    track.bbox = bbox
+                return [bbox]
+
+        bboxes = self._detect(image)[0]
+        with track.lock:
+            # Only a single face is followed
+            track.bbox = bboxes[0] if len(bboxes) == 1 else None
+            track.frames_since_detection = 1
+        return bboxes
+
+    def _find_bbox_near(self, image: np.ndarray,
+                        previous: dlib.rectangle) -> Optional[dlib.rectangle]:
+        padding_x = int(previous.width() * self.roi_padding)
+        padding_y = int(previous.height() * self.roi_padding)
+        height, width = image.shape[:2]
+        left = max(previous.left() - padding_x, 0)
+        top = max(previous.top() - padding_y, 0)
+        right = min(previous.right() + padding_x, width)
+        bottom = min(previous.bottom() + padding_y, height)
+        if right <= left or bottom <= top:
+            return None
+        bboxes, scores = self._detect(image[top:bottom, left:right])
+        if len(bboxes) != 1 or scores[0] < self.min_score:
+            return None
+        bbox = bboxes[0]
+        return dlib.rectangle(bbox.left() + left,
+                              bbox.top() + top,
+                              bbox.right() + left,
+                              bbox.bottom() + top)
+
+    def _detect(self,
+                image: np.ndarray) -> Tuple[List[dlib.rectangle], List[float]]:
+        """Runs the frontal face detector on a BGR or grayscale image and
+        returns the boxes with their scores.
+
+        With ``face_detector.downscale`` above 1, the detector runs on a
+        downscaled grayscale copy of the image, which is much cheaper
+        since its cost grows with the number of pixels, and the boxes
+        are scaled back to the image.
+        """
+        scale = self.downscale
+        if scale > 1:
+            image = cv2.resize(image,
+                               None,
+                               fx=1 / scale,
+                               fy=1 / scale,
+                               interpolation=cv2.INTER_AREA)
+            if image.ndim == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        elif image.ndim == 3:
+            image = image[:, :, ::-1]
+        bboxes, scores, _ = self.detector.run(image, 0, 0.0)
+        if scale > 1:
+            bboxes = [
+                dlib.rectangle(int(round(bbox.left() * scale)),
+                               int(round(bbox.top() * scale)),
+                               int(round(bbox.right() * scale)),
+                               int(round(bbox.bottom() * scale)))
+                for bbox in bboxes
+            ]
+        return list(bboxes), list(scores)
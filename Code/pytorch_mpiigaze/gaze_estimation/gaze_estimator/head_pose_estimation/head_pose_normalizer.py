@@ -1,3 +1,5 @@
+from typing import Sequence
+
 import cv2
 import numpy as np
 from scipy.spatial.transform import Rotation
@@ -6,63 +8,107 @@ from ..common import Camera, FaceParts, FacePartsName
 
 
 def _normalize_vector(vector: np.ndarray) -> np.ndarray:
-    return vector / np.linalg.norm(vector)
+    return vector / np.linalg.norm(vector, axis=-1, keepdims=True)
 
 
 class HeadPoseNormalizer:
-    def __init__(self, camera: Camera, normalized_camera: Camera,
-                 normalized_distance: float):
+    """With ``distorted_images``, the images to normalize are raw camera frames
+    and the lens distortion is removed by the warp itself."""
+    def __init__(self,
+                 camera: Camera,
+                 normalized_camera: Camera,
+                 normalized_distance: float,
+                 distorted_images: bool = False):
         self.camera = camera
         self.normalized_camera = normalized_camera
         self.normalized_distance = normalized_distance
+        self.distorted_images = distorted_images and camera.has_distortion
+        # The cameras never change, so neither do these
+        self._camera_matrix_inv = np.linalg.inv(camera.camera_matrix)
+        self._normalized_camera_matrix = normalized_camera.camera_matrix
+        self._normalized_size = (normalized_camera.width,
+                                 normalized_camera.height)
 
     def normalize(self, image: np.ndarray, eye_or_face: FaceParts) -> None:
-        eye_or_face.normalizing_rot = self._compute_normalizing_rotation(
-            eye_or_face.center, eye_or_face.head_pose_rot)
-        self._normalize_image(image, eye_or_face)
-        self._normalize_head_pose(eye_or_face)
-
-    def _normalize_image(self, image: np.ndarray,
-                         eye_or_face: FaceParts) -> None:
-        camera_matrix_inv = np.linalg.inv(self.camera.camera_matrix)
-        normalized_camera_matrix = self.normalized_camera.camera_matrix
+        self.normalize_many(image, [eye_or_face])
 
-        scale = self._get_scale_matrix(eye_or_face.distance)
-        conversion_matrix = scale @ eye_or_face.normalizing_rot.as_matrix()
+    def normalize_many(self, image: np.ndarray,
+                       parts: Sequence[FaceParts]) -> None:
+        """Normalizes several parts of the same face, such as both eyes, with
+        the matrices of all the parts computed at once."""
+        head_rots = np.stack(
+            [part.head_pose_rot.as_matrix() for part in parts])
+        centers = np.stack([part.center.ravel() for part in parts])
+        normalizing_rots = self._compute_normalizing_rotations(
+            centers, head_rots)
 
-        projection_matrix = normalized_camera_matrix @ conversion_matrix @ camera_matrix_inv
+        scales = np.zeros((len(parts), 3, 3))
+        scales[:, 0, 0] = 1
+        scales[:, 1, 1] = 1
+        distances = np.linalg.norm(centers, axis=1)
+        scales[:, 2, 2] = self.normalized_distance / distances
+        conversion_matrices = scales @ normalizing_rots
+        projection_matrices = (self._normalized_camera_matrix
+                               @ conversion_matrices @ self._camera_matrix_inv)
 
-        normalized_image = cv2.warpPerspective(
-            image, projection_matrix,
-            (self.normalized_camera.width, self.normalized_camera.height))
+        images = [
+            self._warp(image, conversion_matrix, projection_matrix)
+            for conversion_matrix, projection_matrix in zip(
+                conversion_matrices, projection_matrices)
+        ]
+        is_eye = [
+            part.name in {FacePartsName.REYE, FacePartsName.LEYE}
+            for part in parts
+        ]
+        eye_images = [image for image, eye in zip(images, is_eye) if eye]
+        if eye_images and eye_images[0].ndim == 3:
+            # The eye images are stacked so that they are converted in a
+            # single call
+            eye_images = np.split(
+                cv2.cvtColor(np.concatenate(eye_images), cv2.COLOR_BGR2GRAY),
+                len(eye_images))
+        eye_images = iter(eye_images)
 
-        if eye_or_face.name in {FacePartsName.REYE, FacePartsName.LEYE}:
-            normalized_image = cv2.cvtColor(normalized_image,
-                                            cv2.COLOR_BGR2GRAY)
-            normalized_image = cv2.equalizeHist(normalized_image)
-        eye_or_face.normalized_image = normalized_image
+        # See section 4.2 of https://arxiv.org/abs/1711.09017
+        rotations = Rotation.from_matrix(normalizing_rots)
+        normalized_head_rots = Rotation.from_matrix(head_rots) * rotations
+        euler_angles2d = normalized_head_rots.as_euler('XYZ')[:, :2]
+        for i, part in enumerate(parts):
+            part.normalizing_rot = rotations[i]
+            part.normalized_head_rot2d = euler_angles2d[i] * np.array([1, -1])
+            if is_eye[i]:
+                # Equalized one by one, as the histograms of the two eyes
+                # differ
+                part.normalized_image = cv2.equalizeHist(next(eye_images))
+            else:
+                part.normalized_image = images[i]
 
-    @staticmethod
-    def _normalize_head_pose(eye_or_face: FaceParts) -> None:
-        normalized_head_rot = eye_or_face.head_pose_rot * eye_or_face.normalizing_rot
-        euler_angles2d = normalized_head_rot.as_euler('XYZ')[:2]
-        eye_or_face.normalized_head_rot2d = euler_angles2d * np.array([1, -1])
+    def _warp(self, image: np.ndarray, conversion_matrix: np.ndarray,
+              projection_matrix: np.ndarray) -> np.ndarray:
+        if self.distorted_images:
+            # Maps every pixel of the normalized image to a ray of the
+            # camera rotated and scaled by the conversion matrix, and the
+            # ray to the raw image with the distortion
+            maps = cv2.initUndistortRectifyMap(self.camera.camera_matrix,
+                                               self.camera.dist_coefficients,
+                                               conversion_matrix,
+                                               self._normalized_camera_matrix,
+                                               self._normalized_size,
+                                               cv2.CV_16SC2)
+            return cv2.remap(image, maps[0], maps[1], cv2.INTER_LINEAR)
+        return cv2.warpPerspective(image, projection_matrix,
+                                   self._normalized_size)
 
     @staticmethod
-    def _compute_normalizing_rotation(center: np.ndarray,
-                                      head_rot: Rotation) -> Rotation:
-        # See section 4.2 and Figure 9 of https://arxiv.org/abs/1711.09017
-        z_axis = _normalize_vector(center.ravel())
-        head_rot = head_rot.as_matrix()
-        head_x_axis = head_rot[:, 0]
-        y_axis = _normalize_vector(np.cross(z_axis, head_x_axis))
-        x_axis = _normalize_vector(np.cross(y_axis, z_axis))
-        return Rotation.from_matrix(np.vstack([x_axis, y_axis, z_axis]))
+    def _compute_normalizing_rotations(centers: np.ndarray,
+                                       head_rots: np.ndarray) -> np.ndarray:
+        """Returns the rotation matrices of the normalized cameras looking at
+        ``centers``.
 
-    def _get_scale_matrix(self, distance: np.float64) -> np.ndarray:
-        return np.array([
-            [1, 0, 0],
-            [0, 1, 0],
-            [0, 0, self.normalized_distance / distance],
-        ],
-                        dtype=np.float64)
+        See section 4.2 and Figure 9 of https://arxiv.org/abs/1711.09017
+        """
+        z_axes = _normalize_vector(centers)
+        head_x_axes = head_rots[:, :, 0]
+        y_axes = _normalize_vector(np.cross(z_axes, head_x_axes))
+        x_axes = _normalize_vector(np.cross(y_axes, z_axes))
+        return np.stack([x_axes, y_axes, z_axes], axis=1)
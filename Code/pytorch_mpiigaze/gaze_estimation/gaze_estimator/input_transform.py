@@ -0,0 +1,47 @@
+from typing import Callable
+
+import cv2
+import numpy as np
+import yacs.config
+
+from ..types import GazeEstimationMethod
+
+InputTransform = Callable[[np.ndarray], np.ndarray]
+
+
+def create_input_transform(config: yacs.config.CfgNode) -> InputTransform:
+    """Same as :func:`gaze_estimation.create_transform` with NumPy only, so
+    that inference does not need torch.
+
+    Returns a float32 CHW array.
+    """
+    if config.mode == GazeEstimationMethod.MPIIGaze.name:
+        return _transform_mpiigaze
+    elif config.mode == GazeEstimationMethod.MPIIFaceGaze.name:
+        return _create_mpiifacegaze_transform(config)
+    else:
+        raise ValueError
+
+
+def _transform_mpiigaze(image: np.ndarray) -> np.ndarray:
+    return (image.astype(np.float32) / 255)[None, :, :]
+
+
+def _create_mpiifacegaze_transform(
+        config: yacs.config.CfgNode) -> InputTransform:
+    size = config.transform.mpiifacegaze_face_size
+    gray = config.transform.mpiifacegaze_gray
+    mean = np.array([0.406, 0.456, 0.485], dtype=np.float32)[:, None, None]
+    std = np.array([0.225, 0.224, 0.229], dtype=np.float32)[:, None, None]
+
+    def transform(image: np.ndarray) -> np.ndarray:
+        if size != 448:
+            image = cv2.resize(image, (size, size))
+        if gray:
+            image = cv2.cvtColor(
+                cv2.equalizeHist(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)),
+                cv2.COLOR_GRAY2BGR)
+        image = image.transpose(2, 0, 1).astype(np.float32) / 255
+        return (image - mean) / std
+
+    return transform
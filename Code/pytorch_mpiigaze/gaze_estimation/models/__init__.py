@@ -1,8 +1,12 @@
+import copy
 import importlib
+from typing import Tuple
 
 import torch
 import yacs.config
 
+from ..types import GazeEstimationMethod
+
 
 def create_model(config: yacs.config.CfgNode) -> torch.nn.Module:
     dataset_name = config.mode.lower()
@@ -12,3 +16,68 @@ def create_model(config: yacs.config.CfgNode) -> torch.nn.Module:
     device = torch.device(config.device)
     model.to(device)
     return model
+
+
+def create_example_inputs(config: yacs.config.CfgNode,
+                          device: torch.device) -> Tuple[torch.Tensor, ...]:
+    """Random model inputs with the batch of a single face."""
+    if config.mode == GazeEstimationMethod.MPIIGaze.name:
+        images = torch.rand((2, 1, 36, 60), device=device)
+        head_poses = torch.rand((2, 2), device=device)
+        return images, head_poses
+    elif config.mode == GazeEstimationMethod.MPIIFaceGaze.name:
+        size = config.transform.mpiifacegaze_face_size
+        return (torch.rand((1, 3, size, size), device=device), )
+    else:
+        raise ValueError
+
+
+def prepare_for_inference(model: torch.nn.Module,
+                          config: yacs.config.CfgNode,
+                          fuse: bool = True,
+                          channels_last: bool = False,
+                          tolerance: float = 1e-4) -> torch.nn.Module:
+    """Returns a copy of the model in eval mode prepared for inference.
+
+    With ``fuse``, the batch norms are folded into the convolutions
+    before them wherever the topology allows, by the ``fuse`` method of
+    the models that have one. With ``channels_last``, the weights are
+    converted to the NHWC memory format, which the oneDNN convolutions
+    of the CPU prefer. The outputs of the copy are checked against those
+    of the model, and a RuntimeError is raised when they differ by more
+    than ``tolerance``.
+
+    The backward hooks registered for training, e.g. the gradient
+    scaling of the MPIIFaceGaze ResNet, are removed from the copy since
+    TorchScript rejects modules with backward hooks.
+    """
+    model.eval()
+    prepared = copy.deepcopy(model)
+    for module in prepared.modules():
+        module._backward_hooks.clear()
+    if fuse and hasattr(prepared, 'fuse'):
+        prepared.fuse()
+    if channels_last:
+        prepared.to(memory_format=torch.channels_last)
+
+    device = next(model.parameters()).device
+    inputs = create_example_inputs(config, device)
+    with torch.no_grad():
+        expected = model(*inputs)
+        actual = prepared(*to_memory_format(inputs, channels_last))
+    error = float((actual - expected).abs().max())
+    if error > tolerance * max(1.0, float(expected.abs().max())):
+        raise RuntimeError(
+            f'The model prepared for inference differs by {error:.2e}')
+    return prepared
+
+
+def to_memory_format(inputs: Tuple[torch.Tensor, ...],
+                     channels_last: bool) -> Tuple[torch.Tensor, ...]:
+    """Converts the image inputs to the memory format of a model prepared with
+    ``channels_last``."""
+    if not channels_last:
+        return inputs
+    return tuple(
+        x.contiguous(memory_format=torch.channels_last) if x.dim() == 4 else x
+        for x in inputs)
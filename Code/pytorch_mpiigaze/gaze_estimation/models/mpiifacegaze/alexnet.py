@@ -63,7 +63,7 @@ class Model(nn.Module):
         y = F.relu(self.conv2(y))
         y = F.relu(self.conv3(y))
         x = x * y
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = F.dropout(F.relu(self.fc1(x)), p=0.5, training=self.training)
         x = F.dropout(F.relu(self.fc2(x)), p=0.5, training=self.training)
         x = self.fc3(x)
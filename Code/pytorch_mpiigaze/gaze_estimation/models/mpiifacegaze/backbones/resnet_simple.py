@@ -1,6 +1,8 @@
 import torch
+import torch.nn as nn
 import torchvision
 import yacs.config
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 class Model(torchvision.models.ResNet):
@@ -36,6 +38,25 @@ class Model(torchvision.models.ResNet):
             features = self.forward(data)
             self.n_features = features.shape[1]
 
+    def fuse(self) -> None:
+        """Folds every batch norm into the convolution before it, see
+        :func:`gaze_estimation.models.prepare_for_inference`."""
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.bn1)
+        self.bn1 = nn.Identity()
+        for layer in [self.layer1, self.layer2, self.layer3]:
+            for block in layer:
+                # conv3 and bn3 only exist in bottleneck blocks
+                for index in [1, 2, 3]:
+                    conv = getattr(block, f'conv{index}', None)
+                    if conv is None:
+                        continue
+                    bn = getattr(block, f'bn{index}')
+                    setattr(block, f'conv{index}', fuse_conv_bn_eval(conv, bn))
+                    setattr(block, f'bn{index}', nn.Identity())
+                if block.downsample is not None:
+                    conv, bn = block.downsample
+                    block.downsample = fuse_conv_bn_eval(conv, bn)
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.conv1(x)
         x = self.bn1(x)
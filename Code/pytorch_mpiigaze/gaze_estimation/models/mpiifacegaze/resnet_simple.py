@@ -43,10 +43,13 @@ class Model(nn.Module):
 
         self.conv.register_backward_hook(hook)
 
+    def fuse(self) -> None:
+        self.feature_extractor.fuse()
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.feature_extractor(x)
         y = F.relu(self.conv(x))
         x = x * y
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = self.fc(x)
         return x
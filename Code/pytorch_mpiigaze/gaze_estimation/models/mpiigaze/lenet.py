@@ -31,7 +31,7 @@ class Model(nn.Module):
     def forward(self, x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
         x = F.max_pool2d(self.conv1(x), kernel_size=2, stride=2)
         x = F.max_pool2d(self.conv2(x), kernel_size=2, stride=2)
-        x = F.relu(self.fc1(x.view(x.size(0), -1)), inplace=True)
+        x = F.relu(self.fc1(x.reshape(x.size(0), -1)), inplace=True)
         x = torch.cat([x, y], dim=1)
         x = self.fc2(x)
         return x
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import yacs.config
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 def initialize_weights(module: torch.nn.Module) -> None:
@@ -44,6 +45,16 @@ class BasicBlock(nn.Module):
                           padding=0,
                           bias=False))
 
+    def fuse(self) -> None:
+        """Folds bn2 into conv1, the only convolution directly followed by a
+        batch norm.
+
+        bn1 normalizes the block input, which may be a sum with a
+        shortcut.
+        """
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.bn2)
+        self.bn2 = nn.Identity()
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = F.relu(self.bn1(x), inplace=True)
         y = self.conv1(x)
@@ -114,6 +125,18 @@ class Model(nn.Module):
                                  block(out_channels, out_channels, stride=1))
         return stage
 
+    def fuse(self) -> None:
+        """Folds the batch norms into the preceding convolutions, see
+        :func:`gaze_estimation.models.prepare_for_inference`."""
+        # The stem convolution only feeds the pre-activation of the first
+        # block
+        block = self.stage1.block1
+        self.conv = fuse_conv_bn_eval(self.conv, block.bn1)
+        block.bn1 = nn.Identity()
+        for stage in [self.stage1, self.stage2, self.stage3]:
+            for block in stage:
+                block.fuse()
+
     def _forward_conv(self, x: torch.Tensor) -> torch.Tensor:
         x = self.conv(x)
         x = self.stage1(x)
@@ -125,7 +148,7 @@ class Model(nn.Module):
 
     def forward(self, x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
         x = self._forward_conv(x)
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = torch.cat([x, y], dim=1)
         x = self.fc(x)
         return x
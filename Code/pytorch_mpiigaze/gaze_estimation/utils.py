@@ -1,16 +1,23 @@
 import argparse
 import pathlib
 import random
-from typing import Tuple
+from typing import TYPE_CHECKING, Iterator, Tuple
 
+import cv2
 import numpy as np
-import torch
 import yacs.config
 
 from .config import get_default_config
 
+# torch is imported by the functions that use it, so that loading the
+# config of the ONNX Runtime backend does not import it
+if TYPE_CHECKING:
+    import torch
+
 
 def set_seeds(seed: int) -> None:
+    import torch
+
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
@@ -18,6 +25,8 @@ def set_seeds(seed: int) -> None:
 
 
 def setup_cudnn(config) -> None:
+    import torch
+
     torch.backends.cudnn.benchmark = config.cudnn.benchmark
     torch.backends.cudnn.deterministic = config.cudnn.deterministic
 
@@ -32,6 +41,12 @@ def load_config() -> yacs.config.CfgNode:
     if args.config is not None:
         config.merge_from_file(args.config)
     config.merge_from_list(args.options)
+    if config.gaze_estimator.backend == 'onnxruntime':
+        # The ONNX Runtime session falls back to the CPU by itself
+        config.freeze()
+        return config
+
+    import torch
     if not torch.cuda.is_available():
         config.device = 'cpu'
         config.train.train_dataloader.pin_memory = False
@@ -60,8 +75,10 @@ def create_train_output_dir(config: yacs.config.CfgNode) -> pathlib.Path:
 
 
 def convert_to_unit_vector(
-        angles: torch.Tensor
-) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    angles: 'torch.Tensor'
+) -> Tuple['torch.Tensor', 'torch.Tensor', 'torch.Tensor']:
+    import torch
+
     pitches = angles[:, 0]
     yaws = angles[:, 1]
     x = -torch.cos(pitches) * torch.sin(yaws)
@@ -74,8 +91,10 @@ def convert_to_unit_vector(
     return x, y, z
 
 
-def compute_angle_error(predictions: torch.Tensor,
-                        labels: torch.Tensor) -> torch.Tensor:
+def compute_angle_error(predictions: 'torch.Tensor',
+                        labels: 'torch.Tensor') -> 'torch.Tensor':
+    import torch
+
     pred_x, pred_y, pred_z = convert_to_unit_vector(predictions)
     label_x, label_y, label_z = convert_to_unit_vector(labels)
     angles = pred_x * label_x + pred_y * label_y + pred_z * label_z
@@ -97,3 +116,24 @@ class AverageMeter:
         self.sum += val * num
         self.count += num
         self.avg = self.sum / self.count
+
+
+def iterate_frames(path: pathlib.Path,
+                   max_frames: int) -> Iterator[np.ndarray]:
+    """Yields at most ``max_frames`` BGR frames of a video, an image or a
+    directory of images, in the order of their names."""
+    if path.is_dir():
+        paths = sorted(p for p in path.iterdir()
+                       if p.suffix.lower() in {'.jpg', '.jpeg', '.png'})
+        for image_path in paths[:max_frames]:
+            yield cv2.imread(image_path.as_posix())
+        return
+    cap = cv2.VideoCapture(path.as_posix())
+    count = 0
+    while count < max_frames:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        count += 1
+        yield frame
+    cap.release()
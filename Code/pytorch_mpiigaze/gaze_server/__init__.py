@@ -0,0 +1,8 @@
+from .metrics import ServerMetrics, serve_metrics
+from .protocol import (AsyncMessageReader, Encoding, Header, MessageReader,
+                       MessageType, ProtocolError, decode_frame, decode_json,
+                       decode_shm_slot, pack_json, send_frame, send_json,
+                       send_shm_frame)
+from .server import ClientSession, GazeServer
+from .shm import FrameRing
+from .stats import CaptureStats
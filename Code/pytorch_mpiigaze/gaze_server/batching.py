@@ -0,0 +1,112 @@
+import asyncio
+import concurrent.futures
+import logging
+from typing import Callable, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PredictFunction = Callable[[np.ndarray, Optional[np.ndarray]], np.ndarray]
+
+
+class _Request:
+    __slots__ = ('images', 'head_poses', 'future')
+
+    def __init__(self, images: np.ndarray, head_poses: Optional[np.ndarray],
+                 future: asyncio.Future):
+        self.images = images
+        self.head_poses = head_poses
+        self.future = future
+
+
+class InferenceBatcher:
+    """Groups model inputs coming from all clients into one forward pass.
+
+    The first request of a batch waits at most ``max_delay`` seconds for
+    more requests to arrive, and a batch is run as soon as it holds
+    ``max_batch_size`` samples. Batches run one at a time in
+    ``executor``; the requests that arrive meanwhile wait in the queue
+    and go into the next batch, which is run without waiting for
+    ``max_delay`` again when they already fill it. A lone client only
+    pays ``max_delay`` of extra latency.
+    """
+    def __init__(self,
+                 predict: PredictFunction,
+                 executor: concurrent.futures.Executor,
+                 max_batch_size: int = 64,
+                 max_delay: float = 0.005):
+        self._predict = predict
+        self._executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.n_batches = 0
+        self.n_samples = 0
+
+    async def submit(self,
+                     images: np.ndarray,
+                     head_poses: Optional[np.ndarray] = None) -> np.ndarray:
+        """Returns the predictions for ``images``, in the same order."""
+        loop = asyncio.get_running_loop()
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait(_Request(images, head_poses, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            size = len(batch[0].images)
+            deadline = loop.time() + self.max_delay
+            while size < self.max_batch_size:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(
+                            self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    request = self._queue.get_nowait()
+                batch.append(request)
+                size += len(request.images)
+            await self._run_batch(batch)
+
+    async def _run_batch(self, batch: List[_Request]) -> None:
+        loop = asyncio.get_running_loop()
+        # A request that cannot be batched, e.g. with images of another
+        # size, fails its batch but never stops the batcher
+        try:
+            images = np.concatenate([request.images for request in batch])
+            if batch[0].head_poses is None:
+                head_poses = None
+            else:
+                head_poses = np.concatenate(
+                    [request.head_poses for request in batch])
+            predictions = await loop.run_in_executor(self._executor,
+                                                     self._predict, images,
+                                                     head_poses)
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+
+        self.n_batches += 1
+        self.n_samples += len(images)
+        logger.debug(f'Ran a batch of {len(images)} samples from '
+                     f'{len(batch)} requests')
+        start = 0
+        for request in batch:
+            end = start + len(request.images)
+            if not request.future.done():
+                request.future.set_result(predictions[start:end])
+            start = end
@@ -0,0 +1,151 @@
+import concurrent.futures
+import itertools
+import multiprocessing
+from typing import Hashable, Optional, Tuple
+
+import cv2
+import numpy as np
+import yacs.config
+
+from gaze_estimation import GazeEstimator
+from gaze_estimation.gaze_estimator.common import Face, FaceTrack, FaceTracks
+from gaze_estimation.gaze_estimator.head_pose_estimation import to_gray
+
+PreparedFrame = Tuple[Face, np.ndarray, Optional[np.ndarray]]
+
+
+class NoFaceFound(ValueError):
+    reason = 'no_face'
+
+
+class TooManyFaces(ValueError):
+    reason = 'too_many_faces'
+
+
+def prepare_face(gaze_estimator: GazeEstimator,
+                 frame: np.ndarray,
+                 track: Optional[FaceTrack] = None,
+                 timestamp: Optional[float] = None) -> Face:
+    """Runs everything before the gaze model on a resized frame.
+
+    ``track`` holds the state of the video stream the frame comes from
+    and ``timestamp`` is the capture time of the frame, see
+    :meth:`GazeEstimator.estimate_head_pose`. Raises NoFaceFound or
+    TooManyFaces unless exactly one face is found.
+    """
+    undistorted = gaze_estimator.undistort(frame)
+
+    # Converted once for the landmarks and the eye images
+    gray = to_gray(undistorted)
+    faces = gaze_estimator.detect_faces(undistorted, track, gray)
+    if len(faces) == 0:
+        raise NoFaceFound('No face found')
+    if len(faces) != 1:
+        raise TooManyFaces('Too many faces')
+    face = faces[0]
+    gaze_estimator.normalize(undistorted, face, track, gray, timestamp)
+    return face
+
+
+def resize_frame(gaze_estimator: GazeEstimator,
+                 frame: np.ndarray) -> np.ndarray:
+    """Returns ``frame`` itself when it already has the camera size, which is
+    the case for clients following the server's HELLO."""
+    size = (gaze_estimator.camera.width, gaze_estimator.camera.height)
+    if frame.shape[1::-1] == size:
+        return frame
+    return cv2.resize(frame, size)
+
+
+def prepare_frame(gaze_estimator: GazeEstimator,
+                  frame: np.ndarray,
+                  track: Optional[FaceTrack] = None,
+                  timestamp: Optional[float] = None) -> PreparedFrame:
+    face = prepare_face(gaze_estimator, resize_frame(gaze_estimator, frame),
+                        track, timestamp)
+    images, head_poses = gaze_estimator.create_model_input(face)
+    return face, images, head_poses
+
+
+# Face pipeline of a worker process, see FacePipelineExecutor
+_worker_estimator: Optional[GazeEstimator] = None
+_worker_tracks = FaceTracks()
+
+
+def _initialize_worker(config: yacs.config.CfgNode) -> None:
+    global _worker_estimator
+    # Parallelism comes from the number of processes, so keep every
+    # worker on a single core. The workers never run the model, so torch
+    # threads do not matter.
+    cv2.setNumThreads(1)
+    _worker_estimator = GazeEstimator(config, load_model=False)
+
+
+def _prepare_frame_in_worker(frame: np.ndarray, stream_id: Optional[Hashable],
+                             timestamp: Optional[float]) -> PreparedFrame:
+    track = None if stream_id is None else _worker_tracks.get(stream_id)
+    return prepare_frame(_worker_estimator, frame, track, timestamp)
+
+
+class FacePipelineExecutor:
+    """Runs :func:`prepare_frame` in threads or in worker processes.
+
+    dlib, ``cv2.solvePnP`` and ``cv2.warpPerspective`` only partly
+    release the GIL, so threads mostly help overlap I/O. With
+    ``worker_type: process`` every worker process holds its own
+    landmark estimator and head pose normalizer, and frames are fanned
+    out to them, which scales with the number of cores. The gaze model
+    itself is never loaded in the workers.
+
+    Frames are tagged with the id of the stream they come from, and the
+    face of each stream is tracked by the worker processing the frame.
+    Every worker process keeps its own tracks, so all the frames of a
+    stream go to the same process, which has a pool of its own. Frames
+    without a stream id are spread over the processes.
+    """
+    def __init__(self, gaze_estimator: GazeEstimator,
+                 config: yacs.config.CfgNode):
+        worker_type = config.server.face_workers.type
+        num_workers = config.server.face_workers.num_workers
+        self._tracks = FaceTracks()
+        if worker_type == 'thread':
+            self._gaze_estimator = gaze_estimator
+            self._executors = [
+                concurrent.futures.ThreadPoolExecutor(
+                    max_workers=num_workers, thread_name_prefix='gaze_face')
+            ]
+        elif worker_type == 'process':
+            self._gaze_estimator = None
+            # Workers are spawned rather than forked from a server that
+            # already runs threads and holds the gaze model
+            context = multiprocessing.get_context('spawn')
+            self._executors = [
+                concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=context,
+                    initializer=_initialize_worker,
+                    initargs=(config, )) for _ in range(num_workers)
+            ]
+            self._next_executor = itertools.cycle(self._executors)
+        else:
+            raise ValueError(f'Unknown face worker type {worker_type}')
+
+    def submit(self,
+               frame: np.ndarray,
+               stream_id: Optional[Hashable] = None,
+               timestamp: Optional[float] = None) -> concurrent.futures.Future:
+        if self._gaze_estimator is None:
+            if stream_id is None:
+                executor = next(self._next_executor)
+            else:
+                executor = self._executors[hash(stream_id) %
+                                           len(self._executors)]
+            return executor.submit(_prepare_frame_in_worker, frame, stream_id,
+                                   timestamp)
+        track = None if stream_id is None else self._tracks.get(stream_id)
+        return self._executors[0].submit(prepare_frame, self._gaze_estimator,
+                                         frame, track, timestamp)
+
+    def shutdown(self) -> None:
+        for executor in self._executors:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,221 @@
+"""Live metrics of the gaze server in the Prometheus text format.
+
+Only the few metric types the server needs are implemented, so that no
+client library is required. Metrics can be updated from any thread and
+are served over HTTP by :func:`serve_metrics`.
+"""
+import asyncio
+import logging
+import math
+import threading
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+# Seconds, from a fast resize up to a frame stuck behind a slow model
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5)
+
+
+def _format_labels(names: Sequence[str],
+                   values: LabelValues,
+                   extra: str = '') -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(labels) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'{self.name} expects the labels '
+                             f'{self.label_names}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type_name}',
+        ]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+        if not self.label_names:
+            self._values[()] = 0.0
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> Iterable[str]:
+        for key, value in sorted(self._values.items()):
+            yield (f'{self.name}{_format_labels(self.label_names, key)} '
+                   f'{_format_value(value)}')
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf, )
+        # label values -> (bucket counts, sum)
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * len(self.buckets), [0.0])
+            counts, total = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            total[0] += value
+
+    def _samples(self) -> Iterable[str]:
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key,
+                                        f'le="{_format_value(bound)}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.label_names, key)
+            yield f'{self.name}_sum{labels} {_format_value(total[0])}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class ServerMetrics:
+    """All the metrics of the gaze server."""
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self.clients_connected = self._add(
+            Gauge('gaze_clients_connected', 'Connected clients.'))
+        self.connections = self._add(
+            Counter('gaze_connections_total', 'Accepted connections.'))
+        self.frames_received = self._add(
+            Counter('gaze_frames_received_total',
+                    'Frames received from the clients.'))
+        self.frames_processed = self._add(
+            Counter('gaze_frames_processed_total',
+                    'Frames that went through the model pipeline.'))
+        self.frames_dropped = self._add(
+            Counter('gaze_frames_dropped_total',
+                    'Frames received while no capture was running.'))
+        self.frame_errors = self._add(
+            Counter('gaze_frame_errors_total',
+                    'Processed frames without a score, by reason.',
+                    labels=('reason', )))
+        self.frames_in_progress = self._add(
+            Gauge('gaze_frames_in_progress',
+                  'Frames received and not processed yet.'))
+        self.stage_seconds = self._add(
+            Histogram('gaze_stage_seconds',
+                      'Time spent by a frame in each stage, including '
+                      'the wait for a worker.',
+                      labels=('stage', )))
+        self.bytes_received = self._add(
+            Counter('gaze_bytes_received_total',
+                    'Bytes of the messages received from the clients.'))
+        self.bytes_sent = self._add(
+            Counter('gaze_bytes_sent_total',
+                    'Bytes of the messages sent to the clients.'))
+
+    def _add(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+async def serve_metrics(metrics: ServerMetrics, host: str,
+                        port: int) -> asyncio.AbstractServer:
+    """Serves ``GET /metrics`` on the running event loop."""
+    async def handle(reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await reader.readline()
+            # Skip the request headers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split(
+                    '?')[0] == '/metrics':
+                status = '200 OK'
+                body = metrics.render().encode('utf-8')
+            else:
+                status = '404 Not Found'
+                body = b'Not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: text/plain; version=0.0.4; '
+                         f'charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
+        except (ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return server
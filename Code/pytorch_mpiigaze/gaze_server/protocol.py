@@ -0,0 +1,436 @@
+"""Binary framing used between ``client.py`` and the gaze server.
+
+Every message starts with a fixed-width little-endian header followed by
+``payload_size`` bytes of payload. Frame messages carry the raw pixel
+buffer of a ``numpy`` array, whose shape and dtype are described by the
+header, so the receiver can wrap the payload with ``np.frombuffer``
+without any deserialization step. Alternatively, frames can be sent
+compressed with ``cv2.imencode``, which trades some CPU on both ends for
+a much smaller payload when client and server are on different hosts.
+Control messages carry a UTF-8 JSON payload.
+"""
+import asyncio
+import enum
+import json
+import socket
+import struct
+import time
+from typing import Any, Dict, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+MAGIC = b'LGZF'
+VERSION = 2
+
+# magic, version, message type, dtype, encoding, frame id, timestamp,
+# height, width, channels, payload size
+HEADER = struct.Struct('<4sBBBBQdHHHI')
+HEADER_SIZE = HEADER.size
+
+SLOT_INDEX = struct.Struct('<I')
+
+# Upper bound on a single payload, so that a corrupted or malicious
+# header cannot make the receiver allocate an arbitrary amount of memory.
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class MessageType(enum.IntEnum):
+    FRAME = 1
+    # Sent by the server in response to STOP, the JSON payload holds the
+    # statistics of the capture, see stats.CaptureStats
+    SUMMARY = 2
+    # JSON description of a shared-memory frame ring, see shm.FrameRing
+    ATTACH_SHM = 3
+    # Frame stored in a slot of the attached ring. The header describes
+    # the frame and the payload is the slot index.
+    SHM_FRAME = 4
+    # Sent by the server right after accepting a connection. The JSON
+    # payload holds the frame size and color format the client should
+    # capture and send, see GazeServer.
+    HELLO = 5
+    # Sent by the client to control the capture on a connection that is
+    # kept open between exercises. START begins a capture, or continues
+    # a paused one when its JSON payload has ``"resume": true``. Frames
+    # received while the capture is paused or stopped are not processed.
+    # The START payload may hold a ``capture`` id, echoed in the SUMMARY,
+    # and the ``threshold`` under which scores are counted.
+    START = 6
+    PAUSE = 7
+    STOP = 8
+
+
+class Encoding(enum.IntEnum):
+    RAW = 0
+    JPEG = 1
+    PNG = 2
+    WEBP = 3
+
+
+_ENCODING_EXTENSIONS = {
+    Encoding.JPEG: '.jpg',
+    Encoding.PNG: '.png',
+    Encoding.WEBP: '.webp',
+}
+
+# PNG is lossless, so the quality setting does not apply to it. The
+# lowest compression level is used because it is several times faster
+# to encode than the default while compressing camera frames almost as
+# well.
+PNG_COMPRESSION = 1
+
+_DTYPE_CODES = {
+    np.dtype(np.uint8): 1,
+    np.dtype(np.uint16): 2,
+    np.dtype(np.float32): 3,
+}
+_CODE_DTYPES = {code: dtype for dtype, code in _DTYPE_CODES.items()}
+
+
+class Header:
+    __slots__ = ('type', 'dtype', 'encoding', 'frame_id', 'timestamp',
+                 'height', 'width', 'channels', 'payload_size')
+
+    def __init__(self,
+                 type: MessageType,
+                 payload_size: int,
+                 frame_id: int = 0,
+                 timestamp: float = 0.0,
+                 dtype: Optional[np.dtype] = None,
+                 encoding: Encoding = Encoding.RAW,
+                 height: int = 0,
+                 width: int = 0,
+                 channels: int = 0):
+        self.type = type
+        self.payload_size = payload_size
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+        self.dtype = dtype
+        self.encoding = encoding
+        self.height = height
+        self.width = width
+        self.channels = channels
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        if self.channels == 0:
+            return self.height, self.width
+        return self.height, self.width, self.channels
+
+    def pack(self) -> bytes:
+        if self.dtype is None:
+            dtype_code = 0
+        elif self.dtype in _DTYPE_CODES:
+            dtype_code = _DTYPE_CODES[self.dtype]
+        else:
+            raise ValueError(f'Unsupported dtype {self.dtype}')
+        return HEADER.pack(MAGIC, VERSION, self.type, dtype_code,
+                           self.encoding, self.frame_id, self.timestamp,
+                           self.height, self.width, self.channels,
+                           self.payload_size)
+
+    @classmethod
+    def unpack(cls, data: memoryview) -> 'Header':
+        (magic, version, message_type, dtype_code, encoding, frame_id,
+         timestamp, height, width, channels,
+         payload_size) = HEADER.unpack(data)
+        if magic != MAGIC:
+            raise ProtocolError(f'Bad magic {magic!r}')
+        if version != VERSION:
+            raise ProtocolError(f'Unsupported protocol version {version}')
+        if payload_size > MAX_PAYLOAD_SIZE:
+            raise ProtocolError(f'Payload too large ({payload_size} bytes)')
+        try:
+            message_type = MessageType(message_type)
+            encoding = Encoding(encoding)
+        except ValueError as e:
+            raise ProtocolError(str(e)) from e
+        if dtype_code == 0:
+            dtype = None
+        elif dtype_code in _CODE_DTYPES:
+            dtype = _CODE_DTYPES[dtype_code]
+        else:
+            raise ProtocolError(f'Unknown dtype code {dtype_code}')
+        return cls(message_type,
+                   payload_size,
+                   frame_id=frame_id,
+                   timestamp=timestamp,
+                   dtype=dtype,
+                   encoding=encoding,
+                   height=height,
+                   width=width,
+                   channels=channels)
+
+
+def recv_exactly(sock: socket.socket, view: memoryview) -> bool:
+    """Fill ``view`` from ``sock``.
+
+    Returns False if the peer closed the connection before sending
+    anything, and raises ConnectionError if it closed mid-message.
+    """
+    received = 0
+    size = len(view)
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            if received == 0:
+                return False
+            raise ConnectionError('Connection closed in the middle of a '
+                                  'message')
+        received += n
+    return True
+
+
+class MessageReader:
+    """Receives messages from a socket into a reusable buffer.
+
+    The payload returned by :meth:`receive` is a view into the reader's
+    buffer and is only valid until the next call to :meth:`receive`.
+    """
+    def __init__(self, sock: socket.socket, initial_size: int = 640 * 480 * 3):
+        self._sock = sock
+        self._header_buffer = bytearray(HEADER_SIZE)
+        self._buffer = bytearray(initial_size)
+
+    def receive(self) -> Optional[Tuple[Header, memoryview]]:
+        """Returns None when the peer has closed the connection."""
+        if not recv_exactly(self._sock, memoryview(self._header_buffer)):
+            return None
+        header = Header.unpack(memoryview(self._header_buffer))
+        self._buffer, payload = payload_view(header, self._buffer)
+        if header.payload_size and not recv_exactly(self._sock, payload):
+            raise ConnectionError('Connection closed in the middle of a '
+                                  'message')
+        return header, payload
+
+
+def payload_view(header: Header,
+                 buffer: bytearray) -> Tuple[bytearray, memoryview]:
+    """Returns the buffer to receive the payload of ``header`` into and a view
+    of the payload size into it.
+
+    ``buffer`` is replaced by a new one when it is too small.
+    """
+    if header.payload_size > len(buffer):
+        buffer = bytearray(header.payload_size)
+    return buffer, memoryview(buffer)[:header.payload_size]
+
+
+async def async_recv_exactly(loop: asyncio.AbstractEventLoop,
+                             sock: socket.socket, view: memoryview) -> bool:
+    """Same as :func:`recv_exactly` for a non-blocking socket."""
+    received = 0
+    size = len(view)
+    while received < size:
+        n = await loop.sock_recv_into(sock, view[received:])
+        if n == 0:
+            if received == 0:
+                return False
+            raise ConnectionError('Connection closed in the middle of a '
+                                  'message')
+        received += n
+    return True
+
+
+class AsyncMessageReader(MessageReader):
+    """Same as :class:`MessageReader` for a non-blocking socket.
+
+    The header and the payload of a message can also be received
+    separately, so that the caller picks the buffer of the payload once
+    it knows the type of the message. A payload received into a buffer
+    of the caller stays valid until the caller reuses that buffer, which
+    lets it work on several frames at once.
+    """
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 sock: socket.socket,
+                 initial_size: int = 640 * 480 * 3):
+        super().__init__(sock, initial_size)
+        self._loop = loop
+
+    async def receive(self) -> Optional[Tuple[Header, memoryview]]:
+        header = await self.receive_header()
+        if header is None:
+            return None
+        _, payload = await self.receive_payload(header)
+        return header, payload
+
+    async def receive_header(self) -> Optional[Header]:
+        """Returns None when the peer has closed the connection."""
+        if not await async_recv_exactly(self._loop, self._sock,
+                                        memoryview(self._header_buffer)):
+            return None
+        return Header.unpack(memoryview(self._header_buffer))
+
+    async def receive_payload(self,
+                              header: Header,
+                              buffer: Optional[bytearray] = None
+                              ) -> Tuple[bytearray, memoryview]:
+        """Receives the payload that follows ``header``.
+
+        The payload goes into ``buffer``, or into the reader's own
+        buffer when it is None, see :func:`payload_view` for the
+        returned buffer and view.
+        """
+        if buffer is None:
+            self._buffer, payload = payload_view(header, self._buffer)
+            buffer = self._buffer
+        else:
+            buffer, payload = payload_view(header, buffer)
+        if header.payload_size and not await async_recv_exactly(
+                self._loop, self._sock, payload):
+            raise ConnectionError('Connection closed in the middle of a '
+                                  'message')
+        return buffer, payload
+
+
+def encode_frame(frame: np.ndarray, encoding: Encoding,
+                 quality: int) -> Union[bytes, memoryview]:
+    """Returns the payload of a frame message.
+
+    ``quality`` is in the range 1-100 and is used for JPEG and WebP
+    only.
+    """
+    if encoding == Encoding.RAW:
+        return memoryview(np.ascontiguousarray(frame)).cast('B')
+    if frame.dtype != np.uint8:
+        raise ValueError(f'{encoding.name} frames must be uint8, '
+                         f'got {frame.dtype}')
+    if encoding == Encoding.JPEG:
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif encoding == Encoding.WEBP:
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    elif encoding == Encoding.PNG:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION]
+    else:
+        raise ValueError(f'Unknown encoding {encoding}')
+    ok, data = cv2.imencode(_ENCODING_EXTENSIONS[encoding], frame, params)
+    if not ok:
+        raise RuntimeError(f'Failed to encode frame as {encoding.name}')
+    return data.data
+
+
+def decode_frame(header: Header, payload: memoryview) -> np.ndarray:
+    """Returns the image of a frame message.
+
+    Raw frames wrap the payload without copying it, compressed frames
+    are decoded into a new array.
+    """
+    if header.type != MessageType.FRAME:
+        raise ProtocolError(f'Expected a frame, got {header.type.name}')
+    if header.dtype is None:
+        raise ProtocolError('Frame message without dtype')
+    if header.encoding != Encoding.RAW:
+        return _decode_compressed_frame(header, payload)
+    expected_size = int(np.prod(header.shape)) * header.dtype.itemsize
+    if expected_size != header.payload_size:
+        raise ProtocolError(f'Frame of shape {header.shape} needs '
+                            f'{expected_size} bytes, got '
+                            f'{header.payload_size}')
+    return np.frombuffer(payload, dtype=header.dtype).reshape(header.shape)
+
+
+def _decode_compressed_frame(header: Header,
+                             payload: memoryview) -> np.ndarray:
+    data = np.frombuffer(payload, dtype=np.uint8)
+    if header.channels == 0:
+        flags = cv2.IMREAD_GRAYSCALE
+    else:
+        flags = cv2.IMREAD_COLOR
+    frame = cv2.imdecode(data, flags)
+    if frame is None:
+        raise ProtocolError(f'Failed to decode {header.encoding.name} frame')
+    if frame.shape != header.shape:
+        raise ProtocolError(f'Decoded frame has shape {frame.shape}, '
+                            f'expected {header.shape}')
+    return frame
+
+
+def decode_json(payload: memoryview) -> Dict[str, Any]:
+    """Decodes the JSON object of a control message.
+
+    Raises ProtocolError when the payload is not a JSON object.
+    """
+    try:
+        obj = json.loads(bytes(payload).decode('utf-8'))
+    except ValueError as e:
+        # UnicodeDecodeError and JSONDecodeError are both ValueErrors
+        raise ProtocolError(f'Invalid JSON payload: {e}') from e
+    if not isinstance(obj, dict):
+        raise ProtocolError(
+            f'Expected a JSON object, got {type(obj).__name__}')
+    return obj
+
+
+def send_frame(sock: socket.socket,
+               frame: np.ndarray,
+               frame_id: int,
+               timestamp: Optional[float] = None,
+               encoding: Encoding = Encoding.RAW,
+               quality: int = 90) -> int:
+    """Sends a frame and returns the number of payload bytes sent."""
+    if frame.ndim not in (2, 3):
+        raise ValueError(f'Expected an image, got shape {frame.shape}')
+    if timestamp is None:
+        timestamp = time.time()
+    payload = encode_frame(frame, encoding, quality)
+    header = Header(MessageType.FRAME,
+                    len(payload),
+                    frame_id=frame_id,
+                    timestamp=timestamp,
+                    dtype=frame.dtype,
+                    encoding=encoding,
+                    height=frame.shape[0],
+                    width=frame.shape[1],
+                    channels=frame.shape[2] if frame.ndim == 3 else 0)
+    sock.sendall(header.pack())
+    sock.sendall(payload)
+    return len(payload)
+
+
+def send_shm_frame(sock: socket.socket,
+                   frame: np.ndarray,
+                   frame_id: int,
+                   slot: int,
+                   timestamp: Optional[float] = None) -> None:
+    """Sends the descriptor of a frame already written into ``slot``."""
+    if timestamp is None:
+        timestamp = time.time()
+    header = Header(MessageType.SHM_FRAME,
+                    SLOT_INDEX.size,
+                    frame_id=frame_id,
+                    timestamp=timestamp,
+                    dtype=frame.dtype,
+                    height=frame.shape[0],
+                    width=frame.shape[1],
+                    channels=frame.shape[2] if frame.ndim == 3 else 0)
+    sock.sendall(header.pack() + SLOT_INDEX.pack(slot))
+
+
+def decode_shm_slot(header: Header, payload: memoryview) -> int:
+    if header.type != MessageType.SHM_FRAME:
+        raise ProtocolError(f'Expected a shared-memory frame, got '
+                            f'{header.type.name}')
+    if header.dtype is None or header.payload_size != SLOT_INDEX.size:
+        raise ProtocolError('Malformed shared-memory frame message')
+    return SLOT_INDEX.unpack(payload)[0]
+
+
+def pack_json(message_type: MessageType, obj: Any, frame_id: int = 0) -> bytes:
+    data = json.dumps(obj).encode('utf-8')
+    header = Header(message_type,
+                    len(data),
+                    frame_id=frame_id,
+                    timestamp=time.time())
+    return header.pack() + data
+
+
+def send_json(sock: socket.socket,
+              message_type: MessageType,
+              obj: Any,
+              frame_id: int = 0) -> None:
+    sock.sendall(pack_json(message_type, obj, frame_id))
@@ -0,0 +1,35 @@
+from typing import Any, Dict, List
+
+import numpy as np
+
+# Gaze angles (degrees) of a user looking at the center of the screen
+CENTER_PITCH = -6
+CENTER_YAW = 0
+
+
+def find_nearest(array, value):
+    array = np.asarray(array)
+    idx = (np.abs(array - value)).argmin()
+    return array[idx]
+
+
+def error_to_center(angles: Dict[str, List[float]]) -> float:
+    """Returns the score of a frame from the pitch and yaw of each eye, the
+    distance in degrees to the center of the screen of the eye closest to
+    it."""
+    pitch = np.array([angles['reye'][0], angles['leye'][0]])
+    yaw = np.array([angles['reye'][1], angles['leye'][1]])
+    n_pitch = find_nearest(pitch, CENTER_PITCH)
+    n_yaw = find_nearest(yaw, CENTER_YAW)
+    return np.abs(CENTER_PITCH - n_pitch) + np.abs(CENTER_YAW - n_yaw)
+
+
+def eye_angles(face: Any) -> Dict[str, List[float]]:
+    """Returns the pitch and yaw in degrees of the gaze of each eye of a face
+    whose gaze was estimated in MPIIGaze mode."""
+    angles = {}
+    for key in ('reye', 'leye'):
+        eye = getattr(face, key)
+        pitch, yaw = np.rad2deg(eye.vector_to_angle(eye.gaze_vector))
+        angles[key] = [pitch, yaw]
+    return angles
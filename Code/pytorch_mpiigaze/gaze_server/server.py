@@ -0,0 +1,374 @@
+import asyncio
+import itertools
+import logging
+import socket
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from . import protocol
+from .metrics import ServerMetrics, serve_metrics
+from .shm import FrameRing
+from .stats import CaptureStats
+
+logger = logging.getLogger(__name__)
+
+# Called with a frame, the id of the session it was received on and the
+# capture time of the frame
+FrameHandler = Callable[[np.ndarray, int, float], Awaitable[Dict[str, Any]]]
+
+
+class ClientSession:
+    """State kept for each connected client."""
+    def __init__(self, session_id: int, address: Tuple[str, int]):
+        self.session_id = session_id
+        self.address = address
+        self.frames_received = 0
+        self.frames_processed = 0
+        self.last_frame_id = 0
+        # Set by the START, PAUSE and STOP messages of the client
+        self.capturing = False
+        # Statistics of the current or last capture, sent to the client
+        # when it stops the capture
+        self.stats: Optional[CaptureStats] = None
+        # Shared memory of a client on the same host, see shm.FrameRing
+        self.frame_ring: Optional[FrameRing] = None
+
+
+class GazeServer:
+    """Serves many gaze clients concurrently from one event loop.
+
+    Sockets are only read and written on the event loop.
+    ``process_frame`` is a coroutine function, which is expected to run
+    dlib and the gaze model in an executor so a slow frame never blocks
+    the other connections. It also gets the session id, so that it can
+    keep state between the frames of a client, and the capture time of
+    the frame sent by the client. Compressed frames are
+    decoded in the loop's default executor.
+
+    ``capture_format`` is sent to every client in a HELLO message when it
+    connects, e.g. ``{'width': 640, 'height': 480, 'color': 'gray'}``,
+    so that clients capture and convert frames to what the model needs
+    before sending them.
+
+    A client keeps its connection open across exercises and frames are
+    only processed between its START and PAUSE or STOP messages. Frames
+    are not answered one by one: the server keeps statistics of the
+    scores returned by ``process_frame`` for each capture and sends them
+    in a SUMMARY message in response to STOP.
+
+    The server updates ``metrics``, which are served over HTTP in the
+    Prometheus text format when ``metrics_address`` is given.
+    """
+    def __init__(self,
+                 process_frame: FrameHandler,
+                 host: str,
+                 port: int,
+                 capture_format: Optional[Dict[str, Any]] = None,
+                 max_frames_in_flight: int = 1,
+                 backlog: int = 64,
+                 metrics: Optional[ServerMetrics] = None,
+                 metrics_address: Optional[Tuple[str, int]] = None):
+        self._process_frame = process_frame
+        self.host = host
+        self.port = port
+        self.capture_format = capture_format or {}
+        self.max_frames_in_flight = max_frames_in_flight
+        self._backlog = backlog
+        self.metrics = metrics or ServerMetrics()
+        self._metrics_address = metrics_address
+        self.sessions: Dict[int, ClientSession] = {}
+        self._session_ids = itertools.count(1)
+
+    def run(self) -> None:
+        asyncio.run(self.serve_forever())
+
+    async def serve_forever(self) -> None:
+        loop = asyncio.get_running_loop()
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((self.host, self.port))
+        server_socket.listen(self._backlog)
+        server_socket.setblocking(False)
+        logger.info(f'Listening on {self.host}:{self.port}')
+        metrics_server = None
+        if self._metrics_address is not None:
+            metrics_server = await serve_metrics(self.metrics,
+                                                 *self._metrics_address)
+
+        tasks: Set[asyncio.Task] = set()
+        try:
+            while True:
+                conn, address = await loop.sock_accept(server_socket)
+                task = loop.create_task(self._serve_client(conn, address))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+            server_socket.close()
+            if metrics_server is not None:
+                metrics_server.close()
+
+    async def _serve_client(self, conn: socket.socket,
+                            address: Tuple[str, int]) -> None:
+        conn.setblocking(False)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        session = ClientSession(next(self._session_ids), address)
+        self.sessions[session.session_id] = session
+        self.metrics.connections.inc()
+        self.metrics.clients_connected.inc()
+        logger.info(f'[session {session.session_id}] connected from '
+                    f'{address[0]}:{address[1]}')
+        try:
+            await self._send(
+                conn,
+                protocol.pack_json(protocol.MessageType.HELLO,
+                                   self.capture_format))
+            await self._receive_frames(conn, session)
+        except (OSError, protocol.ProtocolError) as e:
+            logger.warning(f'[session {session.session_id}] {e}')
+        finally:
+            self._detach_frame_ring(session)
+            del self.sessions[session.session_id]
+            self.metrics.clients_connected.dec()
+            conn.close()
+            logger.info(f'[session {session.session_id}] disconnected after '
+                        f'{session.frames_processed} frames')
+
+    async def _receive_frames(self, conn: socket.socket,
+                              session: ClientSession) -> None:
+        loop = asyncio.get_running_loop()
+        # Up to max_frames_in_flight frames of the client are processed
+        # at once. A frame takes a slot and the payload buffer that goes
+        # with it before its payload is read, and both are only handed back
+        # once the result of the frame is collected, in the order the
+        # frames were received. Other messages are read into the reader's
+        # own buffer. When the server is behind it stops reading, which
+        # slows the client down through TCP flow control.
+        reader = protocol.AsyncMessageReader(loop, conn)
+        slots = asyncio.Semaphore(self.max_frames_in_flight)
+        free_buffers = [bytearray() for _ in range(self.max_frames_in_flight)]
+        results: asyncio.Queue = asyncio.Queue()
+        collector = loop.create_task(
+            self._collect_results(conn, session, results, slots, free_buffers))
+        try:
+            while not collector.done():
+                header = await reader.receive_header()
+                if header is None:
+                    break
+                self.metrics.bytes_received.inc(protocol.HEADER_SIZE +
+                                                header.payload_size)
+                if header.type not in (protocol.MessageType.FRAME,
+                                       protocol.MessageType.SHM_FRAME):
+                    _, payload = await reader.receive_payload(header)
+                    self._handle_message(session, header, payload, results)
+                    continue
+                session.frames_received += 1
+                session.last_frame_id = header.frame_id
+                self.metrics.frames_received.inc()
+                if not session.capturing:
+                    # Sent before the client stopped or paused the capture.
+                    # It is discarded through the reader's own buffer,
+                    # without waiting for a slot.
+                    _, payload = await reader.receive_payload(header)
+                    self.metrics.frames_dropped.inc()
+                    self._release_shm_slot(session, header, payload)
+                    continue
+                await slots.acquire()
+                if collector.done():
+                    break
+                buffer, payload = await reader.receive_payload(
+                    header, free_buffers.pop())
+                self.metrics.frames_in_progress.inc()
+                task = loop.create_task(
+                    self._handle_frame(session, header, payload))
+                results.put_nowait((header.type, task, buffer))
+            results.put_nowait(None)
+            await collector
+        finally:
+            collector.cancel()
+            while not results.empty():
+                item = results.get_nowait()
+                if item is not None and isinstance(item[1], asyncio.Task):
+                    item[1].cancel()
+                    self.metrics.frames_in_progress.dec()
+
+    def _handle_message(self, session: ClientSession, header: protocol.Header,
+                        payload: memoryview, results: asyncio.Queue) -> None:
+        if header.type == protocol.MessageType.ATTACH_SHM:
+            self._attach_frame_ring(session, protocol.decode_json(payload))
+        elif header.type in (protocol.MessageType.START,
+                             protocol.MessageType.PAUSE,
+                             protocol.MessageType.STOP):
+            options = protocol.decode_json(payload)
+            self._handle_command(session, header.type, options)
+            if header.type != protocol.MessageType.PAUSE:
+                # Statistics are started and summarized in order with the
+                # results of the frames
+                results.put_nowait((header.type, options, None))
+        else:
+            logger.warning(f'[session {session.session_id}] unexpected '
+                           f'{header.type.name} message')
+
+    @staticmethod
+    def _handle_command(session: ClientSession, command: protocol.MessageType,
+                        options: Dict[str, Any]) -> None:
+        session.capturing = command == protocol.MessageType.START
+        if session.capturing and options.get('resume'):
+            action = 'resume'
+        else:
+            action = command.name.lower()
+        logger.info(f'[session {session.session_id}] {action} capture')
+
+    @staticmethod
+    def _start_stats(session: ClientSession, options: Dict[str, Any]) -> None:
+        # A resumed capture keeps its statistics, unless they were lost
+        # with the previous connection
+        if options.get('resume') and session.stats is not None:
+            return
+        threshold = options.get('threshold')
+        session.stats = CaptureStats(
+            options.get('capture'),
+            float(threshold) if threshold is not None else None)
+
+    @staticmethod
+    def _attach_frame_ring(session: ClientSession,
+                           description: Dict[str, Any]) -> None:
+        GazeServer._detach_frame_ring(session)
+        try:
+            session.frame_ring = FrameRing.attach(description)
+        except (OSError, KeyError, ValueError) as e:
+            raise protocol.ProtocolError(
+                f'Cannot attach shared memory: {e}') from e
+        logger.info(f'[session {session.session_id}] attached shared memory '
+                    f'{session.frame_ring.name} with '
+                    f'{session.frame_ring.n_slots} slots')
+
+    @staticmethod
+    def _detach_frame_ring(session: ClientSession) -> None:
+        if session.frame_ring is None:
+            return
+        try:
+            session.frame_ring.close()
+        except BufferError:
+            # A frame view is still referenced by a cancelled task, the
+            # mapping is released when it is garbage collected.
+            pass
+        session.frame_ring = None
+
+    @staticmethod
+    def _release_shm_slot(session: ClientSession, header: protocol.Header,
+                          payload: memoryview) -> None:
+        if (header.type == protocol.MessageType.SHM_FRAME
+                and session.frame_ring is not None):
+            slot = protocol.decode_shm_slot(header, payload)
+            if 0 <= slot < session.frame_ring.n_slots:
+                session.frame_ring.release(slot)
+
+    async def _handle_frame(self, session: ClientSession,
+                            header: protocol.Header,
+                            payload: memoryview) -> Dict[str, Any]:
+        start = time.perf_counter()
+        try:
+            return await self._decode_and_process_frame(
+                session, header, payload)
+        finally:
+            self.metrics.stage_seconds.observe(time.perf_counter() - start,
+                                               stage='total')
+
+    async def _decode_and_process_frame(self, session: ClientSession,
+                                        header: protocol.Header,
+                                        payload: memoryview) -> Dict[str, Any]:
+        if header.type == protocol.MessageType.SHM_FRAME:
+            if session.frame_ring is None:
+                raise protocol.ProtocolError('Shared-memory frame received '
+                                             'before ATTACH_SHM')
+            # The pixels are read in place, the client does not reuse the
+            # slot before it is released.
+            slot = protocol.decode_shm_slot(header, payload)
+            try:
+                frame = session.frame_ring.frame(slot, header.shape,
+                                                 header.dtype)
+            except ValueError as e:
+                raise protocol.ProtocolError(str(e)) from e
+            try:
+                return await self._process_frame(frame, session.session_id,
+                                                 header.timestamp)
+            finally:
+                session.frame_ring.release(slot)
+        elif header.encoding == protocol.Encoding.RAW:
+            frame = protocol.decode_frame(header, payload)
+        else:
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            frame = await loop.run_in_executor(None, protocol.decode_frame,
+                                               header, payload)
+            self.metrics.stage_seconds.observe(time.perf_counter() - start,
+                                               stage='decode')
+        return await self._process_frame(frame, session.session_id,
+                                         header.timestamp)
+
+    async def _send(self, conn: socket.socket, data: bytes) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.sock_sendall(conn, data)
+        self.metrics.bytes_sent.inc(len(data))
+
+    async def _collect_results(self, conn: socket.socket,
+                               session: ClientSession, results: asyncio.Queue,
+                               slots: asyncio.Semaphore,
+                               free_buffers: List[bytearray]) -> None:
+        try:
+            while True:
+                item = await results.get()
+                if item is None:
+                    return
+                message_type, value, buffer = item
+                if message_type == protocol.MessageType.START:
+                    self._start_stats(session, value)
+                elif message_type == protocol.MessageType.STOP:
+                    summary = (session.stats.summary()
+                               if session.stats is not None else {})
+                    await self._send(
+                        conn,
+                        protocol.pack_json(protocol.MessageType.SUMMARY,
+                                           summary))
+                else:
+                    try:
+                        response = await value
+                    except protocol.ProtocolError:
+                        raise
+                    except Exception as e:
+                        # A frame that breaks the pipeline (e.g. a
+                        # cv2.error) only costs that frame, the capture
+                        # goes on and its summary counts the error
+                        logger.exception(f'[session {session.session_id}] '
+                                         f'failed to process a frame')
+                        response = {
+                            'status': 'error',
+                            'message': str(e),
+                            'reason': 'exception',
+                        }
+                    finally:
+                        self.metrics.frames_in_progress.dec()
+                    session.frames_processed += 1
+                    self.metrics.frames_processed.inc()
+                    if response['status'] != 'success':
+                        self.metrics.frame_errors.inc(
+                            reason=response.get('reason', 'error'))
+                    if session.stats is not None:
+                        session.stats.add(response)
+                    free_buffers.append(buffer)
+                    slots.release()
+        except (ConnectionError, protocol.ProtocolError) as e:
+            logger.warning(f'[session {session.session_id}] {e}')
+        except Exception:
+            logger.exception(f'[session {session.session_id}] failed to '
+                             f'collect the results')
+        # Wake up the receiving side, which then sees the connection end
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        slots.release()
@@ -0,0 +1,109 @@
+"""Shared-memory frame transport for a client on the same host.
+
+The client owns a :class:`FrameRing`, a block of shared memory divided
+into ``n_slots`` slots of ``slot_size`` bytes. It writes each frame into
+a free slot and sends only a small descriptor over the socket (a
+``SHM_FRAME`` message with the slot index), and the server reads the
+pixels in place. A state byte per slot, stored after the slots, tells
+whether a slot holds a frame the server has not processed yet: the
+client acquires a free slot before writing a frame and the server
+releases it once done, so no message is needed to hand slots back.
+"""
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+_FREE = 0
+_BUSY = 1
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the block with the
+        # resource tracker, which would unlink the client's memory when
+        # the server exits.
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class FrameRing:
+    def __init__(self,
+                 n_slots: int,
+                 slot_size: int,
+                 name: Optional[str] = None):
+        """Creates the shared memory when ``name`` is None, otherwise attaches
+        to the existing block with that name."""
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+        self._owner = name is None
+        size = n_slots * slot_size + n_slots
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self._shm = _attach(name)
+            if self._shm.size < size:
+                self._shm.close()
+                raise ValueError(f'Shared memory {name} is smaller than '
+                                 f'{n_slots} slots of {slot_size} bytes')
+        self._states = self._shm.buf[n_slots * slot_size:size]
+        if self._owner:
+            self._states[:] = bytes(n_slots)
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'n_slots': self.n_slots,
+            'slot_size': self.slot_size,
+        }
+
+    @classmethod
+    def attach(cls, description: Dict[str, Any]) -> 'FrameRing':
+        return cls(int(description['n_slots']),
+                   int(description['slot_size']),
+                   name=str(description['name']))
+
+    def frame(self, slot: int, shape: Tuple[int, ...],
+              dtype: np.dtype) -> np.ndarray:
+        """Returns a view of the frame stored in ``slot``."""
+        if not 0 <= slot < self.n_slots:
+            raise ValueError(f'Slot {slot} out of range')
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if nbytes > self.slot_size:
+            raise ValueError(f'Frame of shape {shape} does not fit in a '
+                             f'slot of {self.slot_size} bytes')
+        return np.ndarray(shape,
+                          dtype=dtype,
+                          buffer=self._shm.buf,
+                          offset=slot * self.slot_size)
+
+    def acquire(self) -> Optional[int]:
+        """Returns a free slot and marks it busy, or None when the server still
+        holds all the slots."""
+        for slot in range(self.n_slots):
+            if self._states[slot] == _FREE:
+                self._states[slot] = _BUSY
+                return slot
+        return None
+
+    def release(self, slot: int) -> None:
+        self._states[slot] = _FREE
+
+    def write(self, slot: int, frame: np.ndarray) -> np.ndarray:
+        view = self.frame(slot, frame.shape, frame.dtype)
+        view[...] = frame
+        return view
+
+    def close(self) -> None:
+        self._states.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
@@ -0,0 +1,66 @@
+import math
+from typing import Any, Dict, Optional
+
+
+class CaptureStats:
+    """Running statistics of the gaze scores of one capture (exercise).
+
+    Frames are folded in one at a time with Welford's algorithm, so
+    nothing is kept per frame. Frames the model could not score are
+    counted by the ``reason`` of their error response, e.g. ``no_face``.
+    """
+    def __init__(self,
+                 capture_id: Optional[int] = None,
+                 threshold: Optional[float] = None):
+        self.capture_id = capture_id
+        self.threshold = threshold
+        self.frames = 0
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.below_threshold = 0
+        self.errors: Dict[str, int] = {}
+
+    def add(self, response: Dict[str, Any]) -> None:
+        self.frames += 1
+        if response['status'] != 'success':
+            reason = response.get('reason', 'error')
+            self.errors[reason] = self.errors.get(reason, 0) + 1
+            return
+        score = float(response['score'])
+        self.count += 1
+        delta = score - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (score - self.mean)
+        self.min = min(self.min, score)
+        self.max = max(self.max, score)
+        if self.threshold is not None and score < self.threshold:
+            self.below_threshold += 1
+
+    @property
+    def variance(self) -> float:
+        return self._m2 / self.count if self.count else 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        """Returns the statistics as a JSON-serializable dict.
+
+        The score statistics are None when no frame was scored.
+        """
+        scored = self.count > 0
+        fraction_below = None
+        if scored and self.threshold is not None:
+            fraction_below = self.below_threshold / self.count
+        return {
+            'capture': self.capture_id,
+            'frames': self.frames,
+            'count': self.count,
+            'mean': self.mean if scored else None,
+            'variance': self.variance if scored else None,
+            'min': self.min if scored else None,
+            'max': self.max if scored else None,
+            'threshold': self.threshold,
+            'fraction_below_threshold': fraction_below,
+            'errors': dict(self.errors),
+        }
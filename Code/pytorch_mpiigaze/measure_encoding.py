@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Measures how frame compression affects the gaze score.
+
+Every input frame is run through the face pipeline and the gaze model
+once as a raw frame and once per encoding and quality, exactly as the
+server would see it after ``protocol.decode_frame``. For each setting
+the mean payload size and the deviation of ``error_to_center`` from the
+raw frame are reported, which is what the default encoding of
+``Gaze_Capture_Client`` should be chosen from.
+"""
+
+import argparse
+import pathlib
+import time
+from typing import List
+
+import numpy as np
+import torch
+
+from gaze_estimation import (GazeEstimationMethod, GazeEstimator,
+                             get_default_config)
+from gaze_estimation.utils import iterate_frames
+from gaze_server import protocol
+from gaze_server.face_pipeline import prepare_frame
+from gaze_server.scoring import error_to_center, eye_angles
+
+
+def compute_score(gaze_estimator: GazeEstimator, frame: np.ndarray) -> float:
+    """Returns the score the server would give ``frame``, or NaN when not
+    exactly one face is found.
+
+    Frames are scored independently, without a face track, so that the
+    score of a compressed frame does not depend on the frames scored
+    before it.
+    """
+    try:
+        face, images, head_poses = prepare_frame(gaze_estimator, frame)
+    except ValueError:
+        return np.nan
+    predictions = gaze_estimator.predict(images, head_poses)
+    gaze_estimator.apply_predictions(face, predictions)
+    return float(error_to_center(eye_angles(face)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, required=True)
+    parser.add_argument('--input',
+                        type=str,
+                        default='images/test2.jpg',
+                        help='video, image or directory of images')
+    parser.add_argument('--max-frames', type=int, default=300)
+    parser.add_argument('--encodings',
+                        type=str,
+                        nargs='+',
+                        default=['jpeg', 'webp', 'png'])
+    parser.add_argument('--qualities',
+                        type=int,
+                        nargs='+',
+                        default=[50, 70, 80, 90, 95])
+    parser.add_argument('options', default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    config = get_default_config()
+    config.merge_from_file(args.config)
+    config.merge_from_list(args.options)
+    if not torch.cuda.is_available():
+        config.device = 'cpu'
+    config.freeze()
+    if config.mode != GazeEstimationMethod.MPIIGaze.name:
+        parser.error('Frames are only scored in MPIIGaze mode')
+
+    gaze_estimator = GazeEstimator(config)
+    frames = list(iterate_frames(pathlib.Path(args.input), args.max_frames))
+    if not frames:
+        raise RuntimeError(f'No frames could be read from {args.input}')
+    raw_scores = np.array(
+        [compute_score(gaze_estimator, frame) for frame in frames])
+    raw_size = frames[0].nbytes
+    print(f'{len(frames)} frames, {np.isnan(raw_scores).sum()} without a '
+          f'single face, raw payload {raw_size / 1024:.0f} KiB')
+
+    settings = []
+    for name in args.encodings:
+        encoding = protocol.Encoding[name.upper()]
+        if encoding == protocol.Encoding.PNG:
+            settings.append((encoding, 0))
+        else:
+            settings.extend((encoding, q) for q in args.qualities)
+
+    print(f'{"encoding":>8} {"quality":>7} {"KiB":>7} {"ratio":>6} '
+          f'{"enc ms":>7} {"dec ms":>7} {"|d score|":>9} {"max":>7} '
+          f'{"lost":>5}')
+    for encoding, quality in settings:
+        sizes: List[int] = []
+        encode_times: List[float] = []
+        decode_times: List[float] = []
+        scores: List[float] = []
+        for frame in frames:
+            t0 = time.perf_counter()
+            payload = protocol.encode_frame(frame, encoding, quality)
+            t1 = time.perf_counter()
+            header = protocol.Header(protocol.MessageType.FRAME,
+                                     len(payload),
+                                     dtype=frame.dtype,
+                                     encoding=encoding,
+                                     height=frame.shape[0],
+                                     width=frame.shape[1],
+                                     channels=frame.shape[2])
+            decoded = protocol.decode_frame(header, memoryview(payload))
+            t2 = time.perf_counter()
+            sizes.append(len(payload))
+            encode_times.append(t1 - t0)
+            decode_times.append(t2 - t1)
+            scores.append(compute_score(gaze_estimator, decoded))
+        scores = np.array(scores)
+        valid = ~np.isnan(raw_scores) & ~np.isnan(scores)
+        # Frames where the face is found in the raw frame but lost after
+        # compression
+        lost = int((~np.isnan(raw_scores) & np.isnan(scores)).sum())
+        deltas = np.abs(scores[valid] - raw_scores[valid])
+        mean_delta = deltas.mean() if deltas.size else np.nan
+        max_delta = deltas.max() if deltas.size else np.nan
+        mean_size = np.mean(sizes)
+        print(f'{encoding.name.lower():>8} {quality:>7} '
+              f'{mean_size / 1024:>7.1f} {raw_size / mean_size:>6.1f} '
+              f'{np.mean(encode_times) * 1e3:>7.2f} '
+              f'{np.mean(decode_times) * 1e3:>7.2f} '
+              f'{mean_delta:>9.3f} {max_delta:>7.3f} {lost:>5}')
+
+
+if __name__ == '__main__':
+    main()
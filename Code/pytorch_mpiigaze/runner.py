@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
+import asyncio
+import concurrent.futures
 import datetime
 import logging
 import pathlib
-from typing import Optional
+import time
+from typing import Any, Dict, List, Optional
 
 import cv2
 import numpy as np
@@ -11,20 +14,14 @@ import yacs.config
 
 from gaze_estimation import GazeEstimationMethod, GazeEstimator
 from gaze_estimation.gaze_estimator.common import (Face, FacePartsName,
-                                                   Visualizer)
+                                                   FaceTrack, Visualizer)
 from gaze_estimation.utils import load_config
+from gaze_server import GazeServer, ServerMetrics
+from gaze_server.batching import InferenceBatcher
+from gaze_server.face_pipeline import (FacePipelineExecutor, prepare_face,
+                                       resize_frame)
+from gaze_server.scoring import error_to_center
 
-import cv2
-import socket
-import struct
-import pickle
-
-
-HOST_IP = '127.0.0.1'
-HOST_PORT = 5004
-
-CENTER_PITCH = -6
-CENTER_YAW = 0
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -47,31 +44,63 @@ class Runner:
         self.show_landmarks = self.config.demo.show_landmarks
         self.show_normalized_image = self.config.demo.show_normalized_image
         self.show_template_model = self.config.demo.show_template_model
+        # Frames given to run are consecutive frames of one stream
+        self.track = FaceTrack()
 
-    def run(self, frame) -> None:
+    @property
+    def draws(self) -> bool:
+        """Whether frames are drawn on, which is only needed when they are
+        shown or written to a video.
 
+        Otherwise only the angles are computed.
+        """
+        return bool(self.config.demo.display_on_screen or self.writer)
+
+    def run(self, frame, timestamp: Optional[float] = None) -> None:
 
-        #ok, frame = self.cap.read()
 
-        frame = cv2.resize(
-            frame, (self.gaze_estimator.camera.width, self.gaze_estimator.camera.height))
+        #ok, frame = self.cap.read()
 
-        undistorted = cv2.undistort(
-            frame, self.gaze_estimator.camera.camera_matrix,
-            self.gaze_estimator.camera.dist_coefficients)
+        frame = self.resize(frame)
 
-        self.visualizer.set_image(frame.copy())
+        if self.draws:
+            self.set_visualizer_image(frame)
         if self.config.demo.display_on_screen:
             cv2.imshow('frame', self.visualizer.image)
             cv2.waitKey(1000)
 
-        faces = self.gaze_estimator.detect_faces(undistorted)
-        if len(faces) == 0:
-            raise ValueError("No face found")
-        if len(faces) != 1:
-            raise ValueError("Too many faces")
-        face = faces[0]
-        self.gaze_estimator.estimate_gaze(undistorted, face)
+        face = self.prepare(frame, timestamp)
+        images, head_poses = self.gaze_estimator.create_model_input(face)
+        predictions = self.gaze_estimator.predict(images, head_poses)
+        return self.finish(face, predictions)
+
+    def resize(self, frame: np.ndarray) -> np.ndarray:
+        return resize_frame(self.gaze_estimator, frame)
+
+    def set_visualizer_image(self, frame: np.ndarray) -> None:
+        """Sets a BGR copy of the frame, which may be grayscale."""
+        image = self.resize(frame)
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        elif image is frame:
+            image = frame.copy()
+        self.visualizer.set_image(image)
+
+    def prepare(self,
+                frame: np.ndarray,
+                timestamp: Optional[float] = None) -> Face:
+        """Everything before the gaze model, safe to call from several threads
+        at once."""
+        return prepare_face(self.gaze_estimator, frame, self.track, timestamp)
+
+    def finish(self, face: Face, predictions: np.ndarray):
+        """Everything after the gaze model.
+
+        When drawing, the frame must have been set on the visualizer.
+        """
+        self.gaze_estimator.apply_predictions(face, predictions)
+        if not self.draws:
+            return self._compute_gaze_angles(face)
         self._draw_face_bbox(face)
         self._draw_head_pose(face)
         self._draw_landmarks(face)
@@ -194,6 +223,17 @@ class Runner:
         if self.config.demo.display_on_screen:
             cv2.imshow('normalized', normalized)
 
+    def _compute_gaze_angles(self, face: Face) -> Dict[str, List[float]]:
+        eyes_angles = {}
+        if self.config.mode == GazeEstimationMethod.MPIIGaze.name:
+            for key in [FacePartsName.REYE, FacePartsName.LEYE]:
+                eye = getattr(face, key.name.lower())
+                pitch, yaw = np.rad2deg(eye.vector_to_angle(eye.gaze_vector))
+                eyes_angles[key.name.lower()] = [pitch, yaw]
+        elif self.config.mode != GazeEstimationMethod.MPIIFaceGaze.name:
+            raise ValueError
+        return eyes_angles
+
     def _draw_gaze_vector(self, face: Face) -> None:
         length = self.config.demo.gaze_visualization_length
         eyes_angles = {}
@@ -217,17 +257,142 @@ class Runner:
         return eyes_angles
 
 
-def find_nearest(array, value):
-    array = np.asarray(array)
-    idx = (np.abs(array - value)).argmin()
-    return array[idx]
+def error_response(error: ValueError) -> Dict[str, Any]:
+    logger.debug('Error %s', error)
+    return {
+        'status': 'error',
+        'score': 0,
+        'message': str(error),
+        # Counted by the capture statistics of the server, e.g. no_face
+        'reason': getattr(error, 'reason', 'error')
+    }
+
+
+def success_response(angles) -> Dict[str, Any]:
+    # Lazy formatting, this runs for every frame of every client
+    logger.debug('The found angles are: %s', angles)
+    error_tc = error_to_center(angles)
+    logger.debug('The Error to center %s', error_tc)
+    return {
+        'status': 'success',
+        'score': float(error_tc),
+        'message': 'Image received and processed.'
+    }
+
+
+def process_frame(model: Runner,
+                  frame: np.ndarray,
+                  timestamp: Optional[float] = None) -> Dict[str, Any]:
+    # Display the image
+    if model.config.demo.display_on_screen:
+        cv2.imshow('Received', frame)
+        cv2.waitKey(1)
+    ##################################### Calling the model
+    try:
+        angles = model.run(frame, timestamp)
+    #####################################
+    except ValueError as e:
+        return error_response(e)
+    return success_response(angles)
+
+
+class FrameProcessor:
+    """Runs the model for the frames of all the clients of the server.
+
+    The face pipeline runs in the workers configured under
+    ``server.face_workers``. The gaze model then runs in a single model
+    thread, either once per frame or, with ``server.batching.enabled``,
+    once for all the eyes collected by the batcher. Drawing, when the
+    frames are shown or written, stays in the model thread since the
+    visualizer is shared.
+
+    The time spent in each stage is observed in ``metrics``.
+    """
+    def __init__(self,
+                 model: Runner,
+                 config: yacs.config.CfgNode,
+                 metrics: Optional[ServerMetrics] = None):
+        self._model = model
+        self._metrics = metrics or ServerMetrics()
+        self._face_executor = FacePipelineExecutor(model.gaze_estimator,
+                                                   config)
+        self._model_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='gaze_model')
+        self._batcher = None
+        if config.server.batching.enabled:
+            self._batcher = InferenceBatcher(
+                model.gaze_estimator.predict, self._model_executor,
+                config.server.batching.max_batch_size,
+                config.server.batching.max_delay_ms / 1000)
+
+    async def __call__(self,
+                       frame: np.ndarray,
+                       stream_id: Optional[int] = None,
+                       timestamp: Optional[float] = None) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            face, images, head_poses = await asyncio.wrap_future(
+                self._face_executor.submit(frame, stream_id, timestamp))
+        except ValueError as e:
+            return error_response(e)
+        finally:
+            self._observe('face', start)
+        if self._batcher is None:
+            angles = await loop.run_in_executor(self._model_executor,
+                                                self._predict_and_finish,
+                                                frame, face, images,
+                                                head_poses)
+        else:
+            start = time.perf_counter()
+            predictions = await self._batcher.submit(images, head_poses)
+            self._observe('model', start)
+            angles = await loop.run_in_executor(self._model_executor,
+                                                self._finish, frame, face,
+                                                predictions)
+        return success_response(angles)
+
+    def _predict_and_finish(
+            self, frame: np.ndarray, face: Face, images: np.ndarray,
+            head_poses: Optional[np.ndarray]) -> Dict[str, List[float]]:
+        start = time.perf_counter()
+        predictions = self._model.gaze_estimator.predict(images, head_poses)
+        self._observe('model', start)
+        return self._finish(frame, face, predictions)
+
+    def _finish(self, frame: np.ndarray, face: Face,
+                predictions: np.ndarray) -> Dict[str, List[float]]:
+        start = time.perf_counter()
+        if self._model.draws:
+            self._model.set_visualizer_image(frame)
+        angles = self._model.finish(face, predictions)
+        self._observe('finish', start)
+        return angles
+
+    def _observe(self, stage: str, start: float) -> None:
+        self._metrics.stage_seconds.observe(time.perf_counter() - start,
+                                            stage=stage)
+
+    def shutdown(self) -> None:
+        self._face_executor.shutdown()
+        self._model_executor.shutdown(wait=False)
+
+
+def create_capture_format(config: yacs.config.CfgNode,
+                          model: Runner) -> Dict[str, Any]:
+    # Eye patches are converted to grayscale anyway, so in MPIIGaze mode
+    # clients can drop the colors before sending
+    if (config.server.grayscale_transport
+            and config.mode == GazeEstimationMethod.MPIIGaze.name):
+        color = 'gray'
+    else:
+        color = 'bgr'
+    return {
+        'width': model.gaze_estimator.camera.width,
+        'height': model.gaze_estimator.camera.height,
+        'color': color
+    }
 
-def error_to_center(angles):
-    pitch = np.array([angles["reye"][0], angles["leye"][0]])
-    yaw = np.array([angles["reye"][1], angles["leye"][1]])
-    n_pitch = find_nearest(pitch, CENTER_PITCH)
-    n_yaw = find_nearest(yaw, CENTER_YAW)
-    return np.abs(CENTER_PITCH - n_pitch) + np.abs(CENTER_YAW - n_yaw)
 
 def main():
     config = load_config()
@@ -237,81 +402,30 @@ def main():
     SPIN_SERVER = True
     if not SPIN_SERVER:
         frame = cv2.imread("./images/test2.jpg")
-    else:
-
-
-        # Initialize socket <one_time code>
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((HOST_IP, HOST_PORT))
-        server_socket.listen(1)
-
-        print("Waiting for connection...")
-        conn, addr = server_socket.accept()
-        print(f"Connection from: {addr}")
-
-        data = b""
-        payload_size = struct.calcsize("L")
-        #</one_time code >
-
-    while SPIN_SERVER:
-        try:
-            # Retrieve message size
-            while len(data) < payload_size:
-                packet = conn.recv(4096)
-                if not packet:
-                    break
-                data += packet
-
-            packed_msg_size = data[:payload_size]
-            data = data[payload_size:]
-            msg_size = struct.unpack("L", packed_msg_size)[0]
-
-            # Retrieve all data based on message size
-            while len(data) < msg_size:
-                data += conn.recv(4096)
-
-            frame_data = data[:msg_size]
-            data = data[msg_size:]
-
-            # Deserialize the image
-            frame = pickle.loads(frame_data)
-
-            # Display the image
-            if config.demo.display_on_screen:
-                cv2.imshow('Received', frame)
-                cv2.waitKey(1)
-        except Exception as e:
-            print(f"Error: {e}")
-##################################### Calling the model
-        try:
-            angles = model.run(frame)
-#####################################
-        except ValueError as e:
-            print("Error " + str(e))
-            response_dict = {
-                "status": "error",
-                "score": 0,
-                "message": str(e)
-            }
-        else:
-            print("The found angles are: " + str(angles))
-            error_tc = error_to_center(angles)
-            print("The Error to center " + str(error_tc))
-            response_dict = {
-                "status": "success",
-                "score": error_tc,
-                "message": "Image received and processed."
-            }
-        # Example: Generate a response dictionary
-        if SPIN_SERVER:
-            # Serialize and send the dictionary
-            response_data = pickle.dumps(response_dict)
-            response_length = struct.pack("L", len(response_data))
-            conn.sendall(response_length + response_data)
-
-    conn.close()
-    server_socket.close()
-    cv2.destroyAllWindows()
+        print(process_frame(model, frame))
+        return
+
+    # Every connected client is served concurrently, the model itself
+    # runs in workers so the event loop never waits for it
+    metrics = ServerMetrics()
+    processor = FrameProcessor(model, config, metrics)
+    metrics_address = None
+    if config.server.metrics.enabled:
+        metrics_address = (config.server.metrics.host,
+                           config.server.metrics.port)
+    server = GazeServer(
+        processor,
+        config.server.host,
+        config.server.port,
+        capture_format=create_capture_format(config, model),
+        max_frames_in_flight=config.server.max_frames_in_flight,
+        metrics=metrics,
+        metrics_address=metrics_address)
+    try:
+        server.run()
+    finally:
+        processor.shutdown()
+        cv2.destroyAllWindows()
 
 
 if __name__ == '__main__':
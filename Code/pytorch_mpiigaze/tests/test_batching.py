@@ -0,0 +1,99 @@
+import asyncio
+import concurrent.futures
+
+import numpy as np
+
+from gaze_server.batching import InferenceBatcher
+
+
+def run_batcher(predict, requests, max_batch_size=64):
+    """Submits all ``requests`` at once and returns their results, or the
+    exceptions they raised."""
+    async def run():
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            batcher = InferenceBatcher(predict,
+                                       executor,
+                                       max_batch_size,
+                                       max_delay=0.05)
+            futures = [
+                batcher.submit(images, head_poses)
+                for images, head_poses in requests
+            ]
+            return await asyncio.wait_for(
+                asyncio.gather(*futures, return_exceptions=True), 5)
+
+    return asyncio.run(run())
+
+
+def test_predictions_are_scattered_back_in_order():
+    batch_sizes = []
+
+    def predict(images, head_poses):
+        batch_sizes.append(len(images))
+        return images[:, 0] + head_poses[:, 0]
+
+    requests = []
+    for i in range(3):
+        images = np.full((2, 3), i, np.float32)
+        head_poses = np.full((2, 2), 10 * i, np.float32)
+        requests.append((images, head_poses))
+    results = run_batcher(predict, requests)
+
+    assert batch_sizes == [6]
+    for i, result in enumerate(results):
+        np.testing.assert_array_equal(result, [11 * i, 11 * i])
+
+
+def test_batches_are_split_at_max_batch_size():
+    batch_sizes = []
+
+    def predict(images, head_poses):
+        batch_sizes.append(len(images))
+        return images[:, 0]
+
+    requests = [(np.full((2, 3), i, np.float32), None) for i in range(5)]
+    results = run_batcher(predict, requests, max_batch_size=4)
+
+    assert batch_sizes == [4, 4, 2]
+    for i, result in enumerate(results):
+        np.testing.assert_array_equal(result, [i, i])
+
+
+def test_model_errors_fail_the_requests_of_the_batch():
+    def predict(images, head_poses):
+        raise RuntimeError('model failed')
+
+    results = run_batcher(predict, [(np.zeros((2, 3)), None)] * 2)
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_batcher_keeps_running_after_a_batch_cannot_be_assembled():
+    def predict(images, head_poses):
+        return images[:, 0]
+
+    async def run():
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            batcher = InferenceBatcher(predict, executor, max_delay=0.05)
+            # Images of different sizes cannot be concatenated
+            results = await asyncio.gather(batcher.submit(np.zeros((2, 3))),
+                                           batcher.submit(np.zeros((2, 4))),
+                                           return_exceptions=True)
+            after = await asyncio.wait_for(batcher.submit(np.ones((2, 3))), 5)
+            return results, after
+
+    results, after = asyncio.run(run())
+
+    assert all(isinstance(result, ValueError) for result in results)
+    np.testing.assert_array_equal(after, [1, 1])
+
+
+def test_requests_without_head_poses_are_batched():
+    def predict(images, head_poses):
+        assert head_poses is None
+        return images.sum(axis=1)
+
+    results = run_batcher(predict, [(np.ones((1, 3)), None)] * 2)
+
+    for result in results:
+        np.testing.assert_array_equal(result, [3])
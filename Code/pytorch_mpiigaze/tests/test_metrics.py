@@ -0,0 +1,62 @@
+import pytest
+
+from gaze_server.metrics import Counter, Gauge, Histogram, ServerMetrics
+
+
+def test_counter_rendering():
+    counter = Counter('frames_total', 'Frames.', labels=('reason', ))
+    counter.inc(reason='no_face')
+    counter.inc(2, reason='no_face')
+    counter.inc(reason='error')
+    assert counter.render() == [
+        '# HELP frames_total Frames.',
+        '# TYPE frames_total counter',
+        'frames_total{reason="error"} 1.0',
+        'frames_total{reason="no_face"} 3.0',
+    ]
+
+
+def test_gauge_rendering():
+    gauge = Gauge('clients', 'Clients.')
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    assert gauge.render()[1:] == ['# TYPE clients gauge', 'clients 1.0']
+    gauge.set(5)
+    assert gauge.render()[-1] == 'clients 5.0'
+
+
+def test_histogram_rendering():
+    histogram = Histogram('latency', 'Latency.', buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 2.0):
+        histogram.observe(value)
+    assert histogram.render() == [
+        '# HELP latency Latency.',
+        '# TYPE latency histogram',
+        'latency_bucket{le="0.1"} 1',
+        'latency_bucket{le="1.0"} 3',
+        'latency_bucket{le="+Inf"} 4',
+        'latency_sum 3.05',
+        'latency_count 4',
+    ]
+
+
+def test_labels_must_match():
+    counter = Counter('frames_total', 'Frames.', labels=('reason', ))
+    with pytest.raises(ValueError):
+        counter.inc(stage='decode')
+
+
+def test_server_metrics_text():
+    metrics = ServerMetrics()
+    metrics.frames_received.inc()
+    metrics.stage_seconds.observe(0.003, stage='total')
+    text = metrics.render()
+    assert text.endswith('\n')
+    lines = text.splitlines()
+    assert 'gaze_frames_received_total 1.0' in lines
+    assert 'gaze_stage_seconds_bucket{stage="total",le="0.005"} 1' in lines
+    assert 'gaze_stage_seconds_count{stage="total"} 1' in lines
+    # Each metric is declared once
+    names = [line.split()[2] for line in lines if line.startswith('# TYPE')]
+    assert len(names) == len(set(names)) == 10
@@ -0,0 +1,138 @@
+import asyncio
+import socket
+
+import numpy as np
+import pytest
+
+from gaze_server import protocol
+
+
+def test_header_round_trip():
+    header = protocol.Header(protocol.MessageType.FRAME,
+                             480 * 640 * 3,
+                             frame_id=42,
+                             timestamp=1234.5,
+                             dtype=np.dtype(np.uint8),
+                             encoding=protocol.Encoding.JPEG,
+                             height=480,
+                             width=640,
+                             channels=3)
+    data = header.pack()
+    assert len(data) == protocol.HEADER_SIZE
+
+    unpacked = protocol.Header.unpack(memoryview(data))
+    for name in protocol.Header.__slots__:
+        assert getattr(unpacked, name) == getattr(header, name)
+    assert unpacked.shape == (480, 640, 3)
+
+
+def test_header_without_dtype_round_trip():
+    header = protocol.Header(protocol.MessageType.STOP, 2)
+    unpacked = protocol.Header.unpack(memoryview(header.pack()))
+    assert unpacked.type == protocol.MessageType.STOP
+    assert unpacked.dtype is None
+    assert unpacked.shape == (0, 0)
+
+
+@pytest.mark.parametrize('offset, value', [
+    (0, b'XXXX'),
+    (4, bytes([protocol.VERSION + 1])),
+    (5, bytes([200])),
+])
+def test_bad_header_raises_protocol_error(offset, value):
+    data = bytearray(protocol.Header(protocol.MessageType.FRAME, 0).pack())
+    data[offset:offset + len(value)] = value
+    with pytest.raises(protocol.ProtocolError):
+        protocol.Header.unpack(memoryview(data))
+
+
+@pytest.mark.parametrize('shape, dtype', [
+    ((4, 6), np.uint8),
+    ((4, 6, 3), np.uint8),
+    ((4, 6), np.float32),
+])
+def test_raw_frame_round_trip(shape, dtype):
+    frame = np.arange(np.prod(shape)).reshape(shape).astype(dtype)
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        protocol.send_frame(sender, frame, 7)
+        header, payload = protocol.MessageReader(receiver, 16).receive()
+    assert header.type == protocol.MessageType.FRAME
+    assert header.frame_id == 7
+    np.testing.assert_array_equal(protocol.decode_frame(header, payload),
+                                  frame)
+
+
+def test_png_frame_round_trip():
+    frame = np.random.default_rng(0).integers(0, 256, (8, 10, 3), np.uint8)
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        protocol.send_frame(sender, frame, 1, encoding=protocol.Encoding.PNG)
+        header, payload = protocol.MessageReader(receiver).receive()
+    np.testing.assert_array_equal(protocol.decode_frame(header, payload),
+                                  frame)
+
+
+def test_json_and_shm_frame_round_trip():
+    frame = np.zeros((4, 6), np.uint8)
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        protocol.send_json(sender, protocol.MessageType.START, {'capture': 3})
+        protocol.send_shm_frame(sender, frame, 5, slot=2)
+        sender.close()
+        reader = protocol.MessageReader(receiver, 4)
+        header, payload = reader.receive()
+        assert header.type == protocol.MessageType.START
+        assert protocol.decode_json(payload) == {'capture': 3}
+        header, payload = reader.receive()
+        assert header.shape == (4, 6)
+        assert protocol.decode_shm_slot(header, payload) == 2
+        assert reader.receive() is None
+
+
+@pytest.mark.parametrize('payload', [b'\xff\xfe', b'{"capture": ', b'[1, 2]'])
+def test_bad_json_payload_raises_protocol_error(payload):
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decode_json(memoryview(payload))
+
+
+def test_payload_into_caller_buffer_outlives_later_messages():
+    async def receive_all(sock):
+        loop = asyncio.get_running_loop()
+        reader = protocol.AsyncMessageReader(loop, sock, 4)
+        frames = []
+        buffers = [bytearray(), bytearray()]
+        while True:
+            header = await reader.receive_header()
+            if header is None:
+                return frames
+            if header.type == protocol.MessageType.FRAME:
+                buffer, payload = await reader.receive_payload(
+                    header, buffers.pop())
+                frames.append(protocol.decode_frame(header, payload))
+            else:
+                await reader.receive_payload(header)
+
+    sender, receiver = socket.socketpair()
+    receiver.setblocking(False)
+    with sender, receiver:
+        protocol.send_frame(sender, np.ones((4, 6), np.uint8), 1)
+        protocol.send_json(sender, protocol.MessageType.PAUSE, {})
+        protocol.send_frame(sender, np.full((4, 6), 9, np.uint8), 2)
+        protocol.send_json(sender, protocol.MessageType.STOP, {})
+        sender.close()
+        frames = asyncio.run(receive_all(receiver))
+    assert [int(frame.max()) for frame in frames] == [1, 9]
+    assert [int(frame.min()) for frame in frames] == [1, 9]
+
+
+def test_payload_view_grows_small_buffers():
+    header = protocol.Header(protocol.MessageType.FRAME, 10)
+    small = bytearray(4)
+    buffer, view = protocol.payload_view(header, small)
+    assert buffer is not small
+    assert len(view) == 10
+    large = bytearray(16)
+    buffer, view = protocol.payload_view(header, large)
+    assert buffer is large
+    assert len(view) == 10
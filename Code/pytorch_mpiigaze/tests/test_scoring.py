@@ -0,0 +1,18 @@
+import pytest
+
+from gaze_server.scoring import CENTER_PITCH, CENTER_YAW, error_to_center
+
+
+def test_looking_at_the_center_scores_zero():
+    angles = {'reye': [CENTER_PITCH, CENTER_YAW], 'leye': [10.0, 20.0]}
+
+    assert error_to_center(angles) == 0
+
+
+def test_score_uses_the_angles_closest_to_the_center():
+    angles = {
+        'reye': [CENTER_PITCH + 2.0, CENTER_YAW - 8.0],
+        'leye': [CENTER_PITCH - 5.0, CENTER_YAW + 1.0],
+    }
+
+    assert error_to_center(angles) == pytest.approx(3.0)
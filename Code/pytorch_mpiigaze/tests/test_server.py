@@ -0,0 +1,150 @@
+import asyncio
+import socket
+
+import numpy as np
+
+from gaze_server import protocol
+from gaze_server.server import GazeServer
+
+
+def pack_frame(frame: np.ndarray, frame_id: int) -> bytes:
+    header = protocol.Header(protocol.MessageType.FRAME,
+                             frame.nbytes,
+                             frame_id=frame_id,
+                             timestamp=float(frame_id),
+                             dtype=frame.dtype,
+                             height=frame.shape[0],
+                             width=frame.shape[1])
+    return header.pack() + frame.tobytes()
+
+
+async def run_session(server: GazeServer, messages: bytes) -> list:
+    """Sends ``messages`` on one connection, then closes it and returns the
+    messages received from the server."""
+    return await asyncio.wait_for(_run_session(server, messages), 5)
+
+
+async def _run_session(server: GazeServer, messages: bytes) -> list:
+    loop = asyncio.get_running_loop()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    listener.setblocking(False)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.setblocking(False)
+    with listener, client:
+        await loop.sock_connect(client, listener.getsockname())
+        conn, address = await loop.sock_accept(listener)
+        serve = loop.create_task(server._serve_client(conn, address))
+        await loop.sock_sendall(client, messages)
+        client.shutdown(socket.SHUT_WR)
+        reader = protocol.AsyncMessageReader(loop, client)
+        received = []
+        while True:
+            message = await reader.receive()
+            if message is None:
+                break
+            header, payload = message
+            received.append((header.type, protocol.decode_json(payload)))
+        await serve
+    return received
+
+
+def test_frame_buffer_is_kept_until_its_result_is_collected():
+    seen = []
+
+    async def process_frame(frame, session_id, timestamp):
+        # The messages that follow the frame are read meanwhile
+        await asyncio.sleep(0.1)
+        seen.append((int(frame.max()), timestamp))
+        return {'status': 'success', 'score': float(frame.max())}
+
+    server = GazeServer(process_frame, '127.0.0.1', 0, max_frames_in_flight=2)
+    messages = b''.join([
+        protocol.pack_json(protocol.MessageType.START, {'capture': 1}),
+        pack_frame(np.ones((4, 6), np.uint8), 1),
+        protocol.pack_json(protocol.MessageType.PAUSE, {}),
+        pack_frame(np.full((4, 6), 9, np.uint8), 2),
+        protocol.pack_json(protocol.MessageType.STOP, {}),
+    ])
+    received = asyncio.run(run_session(server, messages))
+
+    # The capture time sent by the client is passed along with the frame
+    assert seen == [(1, 1.0)]
+    assert received[0][0] == protocol.MessageType.HELLO
+    assert received[1][0] == protocol.MessageType.SUMMARY
+    summary = received[1][1]
+    assert summary['capture'] == 1
+    assert summary['count'] == 1
+    assert summary['mean'] == 1.0
+
+
+def test_paused_frames_do_not_wait_for_a_slot():
+    release = None
+    seen = []
+
+    async def process_frame(frame, session_id, timestamp):
+        seen.append(int(frame.max()))
+        # Holds the only slot until the STOP message is read
+        await release.wait()
+        return {'status': 'success', 'score': float(frame.max())}
+
+    class Server(GazeServer):
+        def _handle_command(self, session, command, options):
+            super()._handle_command(session, command, options)
+            if command == protocol.MessageType.STOP:
+                release.set()
+
+    async def run(messages):
+        nonlocal release
+        release = asyncio.Event()
+        return await run_session(server, messages)
+
+    server = Server(process_frame, '127.0.0.1', 0, max_frames_in_flight=1)
+    messages = b''.join([
+        protocol.pack_json(protocol.MessageType.START, {'capture': 1}),
+        pack_frame(np.ones((4, 6), np.uint8), 1),
+        protocol.pack_json(protocol.MessageType.PAUSE, {}),
+        pack_frame(np.full((4, 6), 9, np.uint8), 2),
+        pack_frame(np.full((4, 6), 9, np.uint8), 3),
+        protocol.pack_json(protocol.MessageType.STOP, {}),
+    ])
+    received = asyncio.run(run(messages))
+
+    assert seen == [1]
+    assert 'gaze_frames_dropped_total 2.0' in server.metrics.render()
+    assert received[1][1]['count'] == 1
+
+
+def test_failed_frame_is_counted_and_keeps_the_connection():
+    async def process_frame(frame, session_id, timestamp):
+        if frame.max() == 9:
+            raise RuntimeError('broken frame')
+        return {'status': 'success', 'score': float(frame.max())}
+
+    server = GazeServer(process_frame, '127.0.0.1', 0, max_frames_in_flight=2)
+    messages = b''.join([
+        protocol.pack_json(protocol.MessageType.START, {'capture': 1}),
+        pack_frame(np.full((4, 6), 9, np.uint8), 1),
+        pack_frame(np.ones((4, 6), np.uint8), 2),
+        protocol.pack_json(protocol.MessageType.STOP, {}),
+    ])
+    received = asyncio.run(run_session(server, messages))
+
+    summary = received[1][1]
+    assert summary['frames'] == 2
+    assert summary['count'] == 1
+    assert summary['errors'] == {'exception': 1}
+
+
+def test_bad_control_message_closes_the_connection():
+    async def process_frame(frame, session_id, timestamp):
+        return {'status': 'success', 'score': 0.0}
+
+    server = GazeServer(process_frame, '127.0.0.1', 0)
+    payload = b'{"capture": '
+    header = protocol.Header(protocol.MessageType.START, len(payload))
+    received = asyncio.run(run_session(server, header.pack() + payload))
+
+    assert [message[0] for message in received] == [protocol.MessageType.HELLO]
+    assert server.sessions == {}
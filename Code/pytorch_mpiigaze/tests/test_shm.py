@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from gaze_server.shm import FrameRing
+
+
+@pytest.fixture
+def ring():
+    ring = FrameRing(n_slots=3, slot_size=4 * 6 * 3)
+    yield ring
+    ring.close()
+
+
+def test_slots_are_acquired_until_released(ring):
+    assert [ring.acquire() for _ in range(3)] == [0, 1, 2]
+    assert ring.acquire() is None
+    ring.release(1)
+    assert ring.acquire() == 1
+    assert ring.acquire() is None
+
+
+def test_attached_ring_shares_frames_and_slot_states(ring):
+    frame = np.arange(4 * 6 * 3, dtype=np.uint8).reshape(4, 6, 3)
+    slot = ring.acquire()
+    ring.write(slot, frame)
+
+    # Attaching from the same process makes the resource tracker print a
+    # harmless KeyError at exit, the server normally runs elsewhere
+    attached = FrameRing.attach(ring.describe())
+    try:
+        np.testing.assert_array_equal(
+            attached.frame(slot, frame.shape, frame.dtype), frame)
+        # The server releases the slot, the client sees it free again
+        attached.release(slot)
+    finally:
+        attached.close()
+    assert ring.acquire() == slot
+
+
+def test_frame_outside_the_ring_raises(ring):
+    with pytest.raises(ValueError):
+        ring.frame(3, (4, 6), np.uint8)
+    with pytest.raises(ValueError):
+        ring.frame(0, (40, 60), np.uint8)
+
+
+def test_attach_to_smaller_ring_raises(ring):
+    description = dict(ring.describe(), n_slots=30)
+    with pytest.raises(ValueError):
+        FrameRing.attach(description)
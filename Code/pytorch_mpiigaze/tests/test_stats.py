@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from gaze_server.stats import CaptureStats
+
+
+def test_statistics_match_numpy():
+    scores = np.random.default_rng(0).uniform(0, 20, 500)
+    stats = CaptureStats(capture_id=4, threshold=7.0)
+    for score in scores:
+        stats.add({'status': 'success', 'score': score})
+    stats.add({'status': 'error', 'reason': 'no_face'})
+    stats.add({'status': 'error', 'reason': 'no_face'})
+    stats.add({'status': 'error'})
+
+    summary = stats.summary()
+    assert summary['capture'] == 4
+    assert summary['frames'] == len(scores) + 3
+    assert summary['count'] == len(scores)
+    assert summary['mean'] == pytest.approx(np.mean(scores))
+    assert summary['variance'] == pytest.approx(np.var(scores))
+    assert np.sqrt(summary['variance']) == pytest.approx(np.std(scores))
+    assert summary['min'] == scores.min()
+    assert summary['max'] == scores.max()
+    assert summary['fraction_below_threshold'] == pytest.approx(
+        np.mean(scores < 7.0))
+    assert summary['errors'] == {'no_face': 2, 'error': 1}
+
+
+def test_summary_without_scores():
+    stats = CaptureStats(threshold=7.0)
+    stats.add({'status': 'error', 'reason': 'no_face'})
+    summary = stats.summary()
+    assert summary['frames'] == 1
+    assert summary['count'] == 0
+    for key in ('mean', 'variance', 'min', 'max', 'fraction_below_threshold'):
+        assert summary[key] is None
+
+
+def test_no_threshold():
+    stats = CaptureStats()
+    stats.add({'status': 'success', 'score': 1.0})
+    assert stats.summary()['fraction_below_threshold'] is None
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""Quantizes a trained gaze model to INT8.
+
+With ``--mode dynamic``, only the weights of the linear layers are
+quantized and their activations are quantized on the fly. With
+``--mode static``, every layer is quantized with FX graph mode
+quantization, after calibrating the activation ranges on the validation
+split of the training persons, so that the test person stays unseen.
+
+The mean angle error of the float and quantized models on the test
+person, as computed by ``evaluate.test``, and their latency at the batch
+size of a single face are reported. The quantized model is saved as
+TorchScript, which ``GazeEstimator`` loads with
+``gaze_estimator.torchscript_model``. Quantized models run on the CPU
+only.
+"""
+
+import argparse
+import copy
+import pathlib
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.ao.quantization
+import torch.ao.quantization.quantize_fx
+import tqdm
+
+sys.path.append(pathlib.Path(__file__).resolve().parents[1].as_posix())
+
+# isort: off
+from evaluate import test  # noqa: E402
+from gaze_estimation import (  # noqa: E402
+    GazeEstimationMethod, create_dataloader, create_model, get_default_config)
+from gaze_estimation.models import create_example_inputs  # noqa: E402
+# isort: on
+
+
+def calibrate(model: torch.nn.Module, config, n_samples: int) -> None:
+    _, val_loader = create_dataloader(config, is_train=True)
+    n_seen = 0
+    with torch.no_grad():
+        for images, poses, _ in tqdm.tqdm(val_loader, desc='calibration'):
+            if config.mode == GazeEstimationMethod.MPIIGaze.name:
+                model(images, poses)
+            else:
+                model(images)
+            n_seen += len(images)
+            if n_seen >= n_samples:
+                break
+
+
+def quantize(model: torch.nn.Module, config, args) -> torch.nn.Module:
+    if args.mode == 'dynamic':
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear},
+                                                      dtype=torch.qint8)
+    qconfig_mapping = torch.ao.quantization.get_default_qconfig_mapping(
+        args.engine)
+    # The float model is evaluated afterwards, keep it untouched
+    prepared = torch.ao.quantization.quantize_fx.prepare_fx(
+        copy.deepcopy(model), qconfig_mapping,
+        create_example_inputs(config, torch.device('cpu')))
+    calibrate(prepared, config, args.calibration_samples)
+    return torch.ao.quantization.quantize_fx.convert_fx(prepared)
+
+
+def measure_latency(model: torch.nn.Module, inputs: tuple,
+                    n_iterations: int) -> float:
+    """Returns the median latency of a forward pass in milliseconds."""
+    times = []
+    with torch.no_grad():
+        for _ in range(10):
+            model(*inputs)
+        for _ in range(n_iterations):
+            start = time.perf_counter()
+            model(*inputs)
+            times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, required=True)
+    parser.add_argument('--checkpoint',
+                        type=str,
+                        default=None,
+                        help='defaults to test.checkpoint of the config')
+    parser.add_argument('--output-path', '-o', type=str, default=None)
+    parser.add_argument('--mode',
+                        type=str,
+                        choices=['dynamic', 'static'],
+                        default='static')
+    parser.add_argument('--engine',
+                        type=str,
+                        default='x86',
+                        help='quantized engine, x86, fbgemm or qnnpack')
+    parser.add_argument('--calibration-samples', type=int, default=2000)
+    parser.add_argument('--latency-iterations', type=int, default=200)
+    parser.add_argument('options', default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    config = get_default_config()
+    config.merge_from_file(args.config)
+    config.merge_from_list(args.options)
+    # Quantized kernels only exist for the CPU
+    config.device = 'cpu'
+    config.train.train_dataloader.pin_memory = False
+    config.train.val_dataloader.pin_memory = False
+    config.test.dataloader.pin_memory = False
+    config.freeze()
+    torch.backends.quantized.engine = args.engine
+
+    checkpoint_path = pathlib.Path(args.checkpoint or config.test.checkpoint)
+    if args.output_path is None:
+        output_path = checkpoint_path.with_name(
+            f'{checkpoint_path.stem}.{args.mode}_int8.pt')
+    else:
+        output_path = pathlib.Path(args.output_path)
+
+    model = create_model(config)
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    model.load_state_dict(checkpoint['model'])
+    model.eval()
+
+    quantized_model = quantize(model, config, args)
+    # Traced so that the model can be loaded without this script
+    example_inputs = create_example_inputs(config, torch.device('cpu'))
+    with torch.no_grad():
+        scripted_model = torch.jit.freeze(
+            torch.jit.trace(quantized_model, example_inputs))
+    torch.jit.save(scripted_model, output_path.as_posix())
+    print(f'Saved the quantized model to {output_path}')
+
+    test_loader = create_dataloader(config, is_train=False)
+    _, _, float_error = test(model, test_loader, config)
+    _, _, quantized_error = test(scripted_model, test_loader, config)
+    float_latency = measure_latency(model, example_inputs,
+                                    args.latency_iterations)
+    quantized_latency = measure_latency(scripted_model, example_inputs,
+                                        args.latency_iterations)
+
+    print(f'{"":>10} {"error (deg)":>12} {"latency (ms)":>13}')
+    print(f'{"float":>10} {float_error:>12.3f} {float_latency:>13.3f}')
+    print(f'{"int8":>10} {quantized_error:>12.3f} '
+          f'{quantized_latency:>13.3f}')
+    print(f'Error delta: {quantized_error - float_error:+.3f} deg, '
+          f'speedup: {float_latency / quantized_latency:.2f}x')
+
+
+if __name__ == '__main__':
+    main()